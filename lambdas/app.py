@@ -15,11 +15,14 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import json
-import time
-import urllib.request
-import cognito
+import math
+import os
 import token_handler
 import message_helper
+import rate_limiter
+import request_parser
+import log_helper
+import profiler
 import logging
 from botocore.exceptions import ClientError
 
@@ -32,34 +35,58 @@ userpool_id = 'us-west-2_ujo3liqS5'
 app_client_id = 'f7u94ger0vvskunbt50p3j1tb'
 """
 
+# load the public keys of the known issuers on cold start, not on the first request
+token_handler.warm_keys()
+
+# POST /message/batch takes {"messages": [...]} and sends them with SendMessageBatch
+BATCH_RESOURCE = request_parser.BATCH_RESOURCE
+MAX_BATCH_MESSAGES = int(os.environ.get("MAX_BATCH_MESSAGES", "500"))
+
+@message_helper.metrics_flushed
+@profiler.profiled
 def lambda_handler(event, context):
-    #logging.basicConfig(level=logging.INFO)
-    logging.getLogger().setLevel(logging.DEBUG)
-    logging.info(event)
-    if not str(event).__contains__('headers'):
+    #the log level is set by LOG_LEVEL, requests are sampled by id for debug logs
+    with log_helper.sample(getattr(context, "aws_request_id", None)):
+        return publish(event, context)
+
+def publish(event, context):
+    try:
+        request = request_parser.parse_request(event, MAX_BATCH_MESSAGES)
+    except request_parser.RequestError as err:
+        logging.error("Validation Failed: %s", err)
         return {
-            "statusCode": 500,
+            "statusCode": err.status_code,
             "body": json.dumps({
-                "message": "Missing headers",
+                "message": str(err),
             }),
         }
 
-    data = json.loads(event['body'])
-    if 'message' not in data:
-        logging.error("Validation Failed")
-        raise Exception("Couldn't create the message.")
-
-    logging.info("message: " + data['message'])
-    message = data['message']
+    batch = request.batch
+    if batch:
+        messages = request.messages
+        log_helper.debug("messages: %d", len(messages))
+    else:
+        message = request.message
+        log_helper.debug("message: %s", message)
 
+    operation = "send_message_batch" if batch else "send_message"
     try:
-        start = time.time()
         #verify token and get the claims and tenant_id from the token
-        token, claims = token_handler.process_token(event['headers'])
-        end = time.time()
-        logging.debug("Verify token execution time: {}".format(end - start))
+        with message_helper.span("verify_token", operation) as span:
+            token = request.token
+            claims = token_handler.verify_token(token, operation)
+            span.set_tenant(claims.get('custom:tenant_id'))
+            log_helper.set_tenant(claims.get('custom:tenant_id'))
+    except request_parser.RequestError as err:
+        logging.error("Token rejected: %s", err)
+        return {
+            "statusCode": err.status_code,
+            "body": json.dumps({
+                "message": "Invalid token"
+            })
+        }
     except ClientError as err:
-        logging.error("Error with token" + err)
+        logging.error("Error with token: %s", err)
         return {
                 "statusCode": 500,
                 "body": json.dumps({
@@ -67,7 +94,7 @@ def lambda_handler(event, context):
                 })
             }
 
-    logging.debug('Token is valid, now get Identity')
+    log_helper.debug('Token is valid, now get Identity')
     # now we can use the claims
     if not claims['custom:tenant_id']:
        logging.error('No tenant_id attribute found in claims')
@@ -79,20 +106,37 @@ def lambda_handler(event, context):
         }
 
 
+    # shed a tenant over its rate limit before paying for the Cognito session and the send
+    tenant_id = claims['custom:tenant_id']
+    allowed, retry_after = rate_limiter.allow(tenant_id, claims.get('custom:tier'), len(messages) if batch else 1)
+    if not allowed:
+        logging.warning('Rate limit exceeded for tenant %s', tenant_id)
+        message_helper.put_count("throttledCount", {"operation": operation, "tenantId": tenant_id})
+        return {
+            "statusCode": 429,
+            "headers": {
+                "Retry-After": str(int(math.ceil(retry_after)))
+            },
+            "body": json.dumps({
+                "message": "Too many requests"
+            })
+        }
+
     # Send the message using the message helper
     
     # Get Account ID from lambda function arn in the context
     account_id = context.invoked_function_arn.split(":")[4]
     #logger.debug ('Account ID=', account_id)
 
+    if batch:
+        return send_batch(token, claims, account_id, messages)
+
     try:
         # construct message and use function in layer to send the message.
-        start = time.time()
-        message_helper.send_message(token, claims, account_id, "order", message)
-        end = time.time()
-        logging.debug("Message send time: {}".format(end - start))
+        with message_helper.span("publish", operation, claims['custom:tenant_id']):
+            message_helper.send_message(token, claims, account_id, "order", message)
     except ClientError as err:
-        logging.error("Error with sending message" + err)
+        logging.error("Error with sending message: %s", err)
         return {
             "statusCode": 200,
             "body": json.dumps({
@@ -108,6 +152,28 @@ def lambda_handler(event, context):
             })
         }
 
+def send_batch(token, claims, account_id, messages):
+    try:
+        with message_helper.span("publish", "send_message_batch", claims['custom:tenant_id']):
+            result = message_helper.send_message_batch(token, claims, account_id, "order", messages)
+    except ClientError as err:
+        logging.error("Error with sending message batch: %s", err)
+        return {
+            "statusCode": 200,
+            "body": json.dumps({
+                    "message": "Could not send messages"
+                })
+            }
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+                "message": "{} of {} messages sent to queue".format(len(result["successful"]), len(messages)),
+                "successful": result["successful"],
+                "failed": result["failed"]
+            })
+        }
+
 
 # the following is useful to make this script executable in both
 # AWS Lambda and any other local environments
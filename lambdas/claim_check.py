@@ -0,0 +1,78 @@
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import io
+import json
+import log_helper
+import os
+import time
+import uuid
+
+"""
+Claim check for large messages. A body of at least CLAIM_CHECK_MIN_BYTES is written to the
+CLAIM_CHECK_BUCKET under a key prefixed with the tenant id, and the message only carries a
+pointer to it, marked with the claim_check attribute. Bodies over the 256KB SQS limit can be
+published this way and receiving large orders stays fast. The consumer reads the object when
+a handler asks for the body and deletes it once the record is processed. Without a bucket
+every body is sent inline. The consumer needs the same CLAIM_CHECK_BUCKET, the records whose
+pointer names another bucket fail.
+The object store is used through the S3 client interface (put_object, get_object, delete_object)
+so it can be replaced by a local stand-in, see resources/local_aws.py.
+"""
+
+CLAIM_CHECK_BUCKET = os.environ.get("CLAIM_CHECK_BUCKET", "")
+CLAIM_CHECK_MIN_BYTES = int(os.environ.get("CLAIM_CHECK_MIN_BYTES", "131072"))
+CLAIM_CHECK_STORE = "s3"
+
+def should_check_in(message_body):
+    return bool(CLAIM_CHECK_BUCKET) and len(message_body.encode("utf-8")) >= CLAIM_CHECK_MIN_BYTES
+
+def object_key(tenant_id):
+    #the tenant prefix lets the policy of the tenant role limit it to its own objects
+    return "{}/{}/{}".format(tenant_id, time.strftime("%Y/%m/%d", time.gmtime()), uuid.uuid4())
+
+def check_in(s3_client, tenant_id, message_body):
+    """Store the body and return the pointer message to send instead"""
+    data = message_body.encode("utf-8")
+    key = object_key(tenant_id)
+    s3_client.put_object(Bucket = CLAIM_CHECK_BUCKET, Key = key, Body = data)
+    log_helper.debug("Claim check of %d bytes stored as %s", len(data), key)
+    return json.dumps({"bucket": CLAIM_CHECK_BUCKET, "key": key, "size": len(data)})
+
+def get_pointer(record, tenant_id):
+    #the pointer of a record in the Lambda event format, None when the body is inline
+    if "claim_check" not in record["messageAttributes"]:
+        return None
+    pointer = json.loads(record["body"])
+    #the pointer comes from the message, only objects of our bucket are read or deleted
+    if not CLAIM_CHECK_BUCKET or pointer["bucket"] != CLAIM_CHECK_BUCKET:
+        raise ValueError("Claim check bucket {} is not the bucket of the claim checks".format(pointer["bucket"]))
+    if not pointer["key"].startswith(tenant_id + "/"):
+        raise ValueError("Claim check {} does not belong to tenant {}".format(pointer["key"], tenant_id))
+    return pointer
+
+def open_body(s3_client, pointer):
+    #a binary stream of the stored body, read as the handler consumes it
+    return s3_client.get_object(Bucket = pointer["bucket"], Key = pointer["key"])["Body"]
+
+def read_body(s3_client, pointer):
+    return open_body(s3_client, pointer).read().decode("utf-8")
+
+def check_out(s3_client, pointer):
+    s3_client.delete_object(Bucket = pointer["bucket"], Key = pointer["key"])
+
+def inline_stream(body):
+    return io.BytesIO(body.encode("utf-8"))
@@ -0,0 +1,42 @@
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import threading
+
+"""
+AWS clients shared by all invocations of a container. boto3 is imported on the first
+client creation, so handlers that never call AWS do not pay for the import on cold start.
+"""
+
+#(service_name, region_name) -> client
+clients = dict()
+#client creation on the default boto3 session is not thread safe
+clients_lock = threading.RLock()
+
+def create_client(service_name, region_name=None, **credentials):
+    import boto3
+    with clients_lock:
+        return boto3.client(service_name, region_name=region_name, **credentials)
+
+def get_client(service_name, region_name=None):
+    key = (service_name, region_name)
+    client = clients.get(key)
+    if client is None:
+        with clients_lock:
+            client = clients.get(key)
+            if client is None:
+                client = clients[key] = create_client(service_name, region_name)
+    return client
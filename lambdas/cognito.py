@@ -26,14 +26,24 @@
   print (keys_url)
 """
 
-import boto3
-from jose import jwk, jwt
-from jose.utils import base64url_decode
-from boto3.session import Session
-import logging
+import clients
+import log_helper
+from collections import OrderedDict
+import os
+import threading
+import time
 
+# The credentials of a tenant identity are reused, together with a session and a warm
+# SQS client, until CREDENTIALS_REFRESH_MARGIN seconds before they expire. At most
+# SESSION_CACHE_SIZE identities are kept, the least recently used one is dropped first
+CREDENTIALS_REFRESH_MARGIN = int(os.environ.get("CREDENTIALS_REFRESH_MARGIN", "300"))
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "256"))
 
-def get_session(token, claims, account_id):
+#(identity pool id, sub) -> {"credentials": dict, "region": str, "sqs": client, "expiration": seconds, "s3": client when used}
+session_cache = OrderedDict()
+session_cache_lock = threading.Lock()
+
+def create_tenant_session(token, claims, account_id):
 
     #get login key from the iss(uer) and replace https://
     issuer = str(claims['iss'])
@@ -44,14 +54,14 @@ def get_session(token, claims, account_id):
     identityPoolId=str(claims['custom:identity_pool'])
     AWS_REGION=identityPoolId.split(':')[0]
 
-    client = boto3.client('cognito-identity', AWS_REGION)
+    client = clients.get_client('cognito-identity', AWS_REGION)
     cognito_identity_id = client.get_id(AccountId=account_id,
     IdentityPoolId=identityPoolId,
     Logins={
         issuer : token
     })
 
-    logging.debug('Cognito Identity Id:{}\n'.format(cognito_identity_id))
+    log_helper.debug('Cognito Identity Id: %s', cognito_identity_id['IdentityId'])
 
     resp = client.get_credentials_for_identity(
                 IdentityId=cognito_identity_id['IdentityId'], 
@@ -60,21 +70,68 @@ def get_session(token, claims, account_id):
 
     # The resp contains the actual temporary AWS secret/access codes and a session token, to be
     # used with the rest of the AWS APIs
-    secretKey = resp['Credentials']['SecretKey']
-    accessKey = resp['Credentials']['AccessKeyId']
-    sessionToken = resp['Credentials']['SessionToken']
+    credentials = {
+        "aws_access_key_id": resp['Credentials']['AccessKeyId'],
+        "aws_secret_access_key": resp['Credentials']['SecretKey'],
+        "aws_session_token": resp['Credentials']['SessionToken'],
+    }
 
     # Now you can use Boto3 like you would if you were using your own secret keys
     # what you will see in any Boto3 example on the web
-    session = Session(aws_access_key_id=accessKey,
-                        aws_secret_access_key=secretKey,
-                        aws_session_token=sessionToken,
-                        region_name=AWS_REGION)
-    return session
+    return {
+        "credentials": credentials,
+        "region": AWS_REGION,
+        "sqs": clients.create_client('sqs', AWS_REGION, **credentials),
+        "expiration": resp['Credentials']['Expiration'].timestamp(),
+    }
+
+def cached_tenant_session(claims):
+    #the cached session of the identity, None when the token has to be exchanged
+    key = (claims['custom:identity_pool'], claims['sub'])
+    with session_cache_lock:
+        tenant_session = session_cache.get(key)
+        if tenant_session is not None:
+            if time.time() < tenant_session["expiration"] - CREDENTIALS_REFRESH_MARGIN:
+                session_cache.move_to_end(key)
+                return tenant_session
+            del session_cache[key]
+    return None
+
+def get_tenant_session(token, claims, account_id):
+    tenant_session = cached_tenant_session(claims)
+    if tenant_session is not None:
+        return tenant_session
+    key = (claims['custom:identity_pool'], claims['sub'])
+
+    #new identity or credentials about to expire, exchange the token again
+    tenant_session = create_tenant_session(token, claims, account_id)
+    log_helper.debug('Credentials for identity %s cached', key)
+    if SESSION_CACHE_SIZE > 0:
+        with session_cache_lock:
+            session_cache[key] = tenant_session
+            while len(session_cache) > SESSION_CACHE_SIZE:
+                session_cache.popitem(last=False)
+    return tenant_session
+
+def get_session(token, claims, account_id):
+    from boto3.session import Session
+    tenant_session = get_tenant_session(token, claims, account_id)
+    return Session(region_name=tenant_session["region"], **tenant_session["credentials"])
+
+def get_sqs_client(token, claims, account_id):
+    return get_tenant_session(token, claims, account_id)["sqs"]
+
+def get_s3_client(token, claims, account_id):
+    #created on first use, only tenants sending claim checks need it
+    tenant_session = get_tenant_session(token, claims, account_id)
+    if "s3" not in tenant_session:
+        tenant_session["s3"] = clients.create_client('s3', tenant_session["region"], **tenant_session["credentials"])
+    return tenant_session["s3"]
 
 # the following is useful to make this script executable in both
 # AWS Lambda and any other local environments
 if __name__ == '__main__':
+    from jose import jwt
     account_id='<account>'
     token = '<sometoken>'
     claims = jwt.get_unverified_claims(token)
@@ -1,29 +1,183 @@
 from __future__ import print_function
+import claim_check
+import clients
+import fair_scheduler
+import idempotency
+import log_helper
 import message_helper
-from time import sleep
+import profiler
+import retry_scheduler
 import logging
+import os
+import time
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 
+"""
+The records of a batch are processed concurrently by at most CONSUMER_WORKERS threads.
+Each record is dispatched to the handler registered for its tenant, or to process_order
+when the tenant has none. Records whose handler raised are returned in batchItemFailures
+so only those messages are retried (the event source needs ReportBatchItemFailures).
+The records are submitted in the tenant fair order of fair_scheduler, and the records it
+defers are returned as failures too so they are not deleted.
+Records of a FIFO queue are processed in order within their message group, the groups
+concurrently. After a record of a group failed the next ones are not processed and are
+returned as failures too, so the group is received again from the failed record.
+Messages already processed, see idempotency, are acknowledged without calling the handler.
+The retry of a failed record is delayed with an exponential backoff, and a record received
+too many times is moved to the dead-letter queue of its tenant, see retry_scheduler.
+Handlers read the payload with read_body or open_body, which fetch the body of a claim
+check from the object store. The object is deleted after the handler succeeded.
+"""
+
+CONSUMER_WORKERS = int(os.environ.get("CONSUMER_WORKERS", "10"))
+
+executor = ThreadPoolExecutor(max_workers=CONSUMER_WORKERS)
+
+#tenant_id -> handler(record, tenant_id)
+tenant_handlers = dict()
+
+def tenant_handler(tenant_id):
+    #decorator to register the business handler of a tenant
+    def register(handler):
+        tenant_handlers[tenant_id] = handler
+        return handler
+    return register
+
+def process_order(record, tenant_id):
+    #default business logic, the order is processed in the context of the tenant
+    log_helper.debug("Process order %s for tenant %s", record["messageId"], tenant_id)
+
+def process_record(record):
+    if not fair_scheduler.has_tenant(record):
+        raise ValueError("Message {} has no tenant_id attribute".format(record["messageId"]))
+    tenant_id = fair_scheduler.record_tenant(record)
+    with log_helper.sample(record["messageId"], tenant_id):
+        handle_record(record, tenant_id)
+
+def handle_record(record, tenant_id):
+    log_helper.debug("record: %s", record)
+    #a message already processed is acknowledged without running the handler again,
+    #the average of duplicateRate is the share of duplicates received by the tenant
+    key = idempotency.record_key(record, tenant_id)
+    duplicate = idempotency.is_processed(key)
+    message_helper.put_value("duplicateRate", 1 if duplicate else 0, {"operation": "receive_message", "tenantId": tenant_id})
+    if duplicate:
+        log_helper.debug("Message %s already processed", record["messageId"])
+        return
+
+    attributes=record["messageAttributes"]
+    #the body of a claim check is only fetched when the handler reads it, see read_body
+    pointer = claim_check.get_pointer(record, tenant_id)
+    #the body as sent, for the dead-letter queue
+    record["sentBody"] = record["body"]
+    if pointer is None:
+        #enveloped bodies are decoded so the handlers always get the plain text payload
+        record["body"] = message_helper.decode_body(record["body"], attributes)
+    else:
+        record["claimCheck"] = pointer
+    message_id = record["messageId"]
+    source_arn = record["eventSourceARN"]
+    queue_name = source_arn.split(":")[-1]
+
+    #time the message waited in the queue, to compare tenants sharing a pool
+    sent_timestamp = record.get("attributes", {}).get("SentTimestamp")
+    if sent_timestamp:
+        message_helper.put_value("queueDelay", time.time() * 1000 - int(sent_timestamp),
+            {"operation": "receive_message", "tenantId": tenant_id}, unit="Milliseconds")
+
+    handler = tenant_handlers.get(tenant_id, process_order)
+    handler(record, tenant_id)
+
+    if pointer is not None:
+        try:
+            claim_check.check_out(clients.get_client("s3"), pointer)
+        except ClientError as err:
+            #the bucket lifecycle rule removes it later
+            logging.error("Could not delete claim check %s: %s", pointer["key"], err)
+
+    idempotency.mark_processed(key)
+    #count the received message for metrics
+    message_helper.count_message("receive_message", tenant_id, queue_name, message_id)
+
+def read_body(record):
+    """The payload of the record, read from the object store for a claim check"""
+    pointer = record.get("claimCheck")
+    if pointer is None:
+        return record["body"]
+    return claim_check.read_body(clients.get_client("s3"), pointer)
+
+def open_body(record):
+    """The payload of the record as a binary stream, to read large claim checks in parts"""
+    pointer = record.get("claimCheck")
+    if pointer is None:
+        return claim_check.inline_stream(record["body"])
+    return claim_check.open_body(clients.get_client("s3"), pointer)
+
+def process_group(records):
+    """Process the records of a FIFO message group in order, returns the ids of the records not processed"""
+    for position, record in enumerate(records):
+        try:
+            process_record(record)
+        except Exception:
+            logging.exception("Processing of message %s failed, %d records of its group skipped",
+                record["messageId"], len(records) - position - 1)
+            return [remaining["messageId"] for remaining in records[position:]]
+    return []
+
+@message_helper.metrics_flushed
+@profiler.profiled
 def lambda_handler(event, context):
-    logging.getLogger().setLevel(logging.DEBUG)
-    for record in event['Records']:
-        logging.debug("record: " + str(record))
-        #payload=record["body"]
-        attributes=record["messageAttributes"]
-        tenant_id = attributes["tenant_id"]["stringValue"]
-        message_id = record["messageId"]
-        source_arn = record["eventSourceARN"]
-        queue_name = source_arn.split(":")[-1]
-        #print(str(payload))
-           #log entry for published message for metrics
-          
-        message_helper.log({
-            "operation": "receive_message",
-            "messageId": message_id,
-            "tenantId": tenant_id,
-            "messageCount" : "1",
-            "queue" : queue_name,
-        }, metrics=["messageCount"], dimensions=["operation", "tenantId"], context=None)  
-        #sleep to slowdown consumer so we can see messages going to both queues.  
-        sleep(1.0)
-
- 
+    return {"batchItemFailures": process_batch(event['Records'])}
+
+def process_batch(records):
+    """Process SQS records in the Lambda event format, returns the batchItemFailures entries"""
+    with message_helper.span("schedule", "receive_message"):
+        ordered, deferred = fair_scheduler.schedule(records)
+        if deferred:
+            try:
+                fair_scheduler.defer(deferred)
+            except ClientError as err:
+                #the deferred records come back after the visibility timeout of the queue instead
+                logging.error("Could not defer records: %s", err)
+            for record in deferred:
+                message_helper.put_count("deferredCount", {"operation": "receive_message", "tenantId": fair_scheduler.record_tenant(record)})
+    with message_helper.span("process", "receive_message"):
+        failed, skipped = process_records(ordered)
+    with message_helper.span("retry", "receive_message"):
+        retried = retry_scheduler.retry(failed) if failed else []
+
+    failures = [{"itemIdentifier": record["messageId"]} for record in deferred + retried]
+    failures.extend({"itemIdentifier": message_id} for message_id in skipped)
+    logging.info("Processed %d records, %d deferred, %d failed, %d dead-lettered",
+        len(ordered), len(deferred), len(failed) + len(skipped), len(failed) - len(retried))
+    return failures
+
+def process_records(ordered):
+    """Process the records concurrently, returns (records that failed, ids of the FIFO records skipped)"""
+    futures = []
+    #message group id -> records of the group in order
+    groups = dict()
+    for record in ordered:
+        group_id = record.get("attributes", {}).get("MessageGroupId")
+        if group_id is None:
+            futures.append((record, executor.submit(process_record, record)))
+        else:
+            groups.setdefault(group_id, []).append(record)
+    group_futures = [(group_records, executor.submit(process_group, group_records)) for group_records in groups.values()]
+
+    failed = []
+    skipped = []
+    for record, future in futures:
+        try:
+            future.result()
+        except Exception:
+            logging.exception("Processing of message %s failed", record["messageId"])
+            failed.append(record)
+    for group_records, future in group_futures:
+        message_ids = future.result()
+        if message_ids:
+            #the skipped records are received after the failed one, they keep their visibility
+            failed.append(group_records[len(group_records) - len(message_ids)])
+            skipped.extend(message_ids[1:])
+    return failed, skipped
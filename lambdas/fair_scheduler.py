@@ -0,0 +1,120 @@
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+import logging
+import os
+
+import clients
+
+"""
+Tenant fair scheduling of the records of a pooled queue batch, with deficit round robin.
+The records are grouped by their tenant_id attribute and ordered so that, in each round,
+a tenant gets as many records as its weight (TENANT_WEIGHTS, a JSON object of tenant to
+weight, default 1). With FAIR_SHARE_RECORDS set, a tenant processes at most
+FAIR_SHARE_RECORDS * weight records of a batch shared with other tenants. Its other records
+are deferred: their
+visibility is changed to FAIR_DEFER_SECONDS so they are received again later and the
+records of other tenants behind them in the queue are received first. Every deferral
+counts as a receive for the maxReceiveCount of a redrive policy.
+Records without a tenant_id attribute are scheduled as the tenant UNKNOWN_TENANT, the consumer
+fails them one by one instead of the batch.
+"""
+
+TENANT_WEIGHTS = json.loads(os.environ.get("TENANT_WEIGHTS", "{}"))
+FAIR_SHARE_RECORDS = int(os.environ.get("FAIR_SHARE_RECORDS", "0"))
+FAIR_DEFER_SECONDS = int(os.environ.get("FAIR_DEFER_SECONDS", "5"))
+
+def tenant_weight(tenant_id):
+    return max(float(TENANT_WEIGHTS.get(tenant_id, 1)), 0.01)
+
+#the tenant of the records without a tenant_id attribute, they fail on their own in the consumer
+UNKNOWN_TENANT = "unknown"
+
+def has_tenant(record):
+    return bool((record.get("messageAttributes", {}).get("tenant_id") or {}).get("stringValue"))
+
+def record_tenant(record):
+    if not has_tenant(record):
+        return UNKNOWN_TENANT
+    return record["messageAttributes"]["tenant_id"]["stringValue"]
+
+def schedule(records):
+    """Returns (records in processing order, records to defer)"""
+    by_tenant = dict()
+    for record in records:
+        by_tenant.setdefault(record_tenant(record), []).append(record)
+
+    quotas = dict()
+    for tenant_id, tenant_records in by_tenant.items():
+        quota = len(tenant_records)
+        #a batch of a single tenant, like one from a silo queue, is never deferred
+        if FAIR_SHARE_RECORDS > 0 and len(by_tenant) > 1:
+            quota = min(quota, max(int(FAIR_SHARE_RECORDS * tenant_weight(tenant_id)), 1))
+        quotas[tenant_id] = quota
+
+    ordered = []
+    deficits = dict.fromkeys(by_tenant, 0)
+    positions = dict.fromkeys(by_tenant, 0)
+    active = list(by_tenant)
+    while active:
+        for tenant_id in list(active):
+            deficits[tenant_id] += tenant_weight(tenant_id)
+            while deficits[tenant_id] >= 1 and positions[tenant_id] < quotas[tenant_id]:
+                ordered.append(by_tenant[tenant_id][positions[tenant_id]])
+                positions[tenant_id] += 1
+                deficits[tenant_id] -= 1
+            if positions[tenant_id] >= quotas[tenant_id]:
+                active.remove(tenant_id)
+
+    deferred = [record for tenant_id, tenant_records in by_tenant.items()
+                for record in tenant_records[positions[tenant_id]:]]
+    return ordered, deferred
+
+def queue_url(source_arn):
+    #arn:aws:sqs:<region>:<account>:<queue name>
+    _, _, _, region, account_id, queue_name = source_arn.split(":")
+    return "https://sqs.{}.amazonaws.com/{}/{}".format(region, account_id, queue_name)
+
+def defer(records, visibility_timeout=None):
+    """Change the visibility of the records, returns the message ids it could not change"""
+    if visibility_timeout is None:
+        visibility_timeout = FAIR_DEFER_SECONDS
+    return change_visibility([(record, visibility_timeout) for record in records])
+
+def change_visibility(timeouts):
+    """Change the visibility of each (record, visibility timeout), returns the message ids it could not change"""
+    by_queue = dict()
+    for record, visibility_timeout in timeouts:
+        by_queue.setdefault(record["eventSourceARN"], []).append((record, visibility_timeout))
+
+    sqs_client = clients.get_client("sqs")
+    failed = []
+    for source_arn, queue_records in by_queue.items():
+        for start in range(0, len(queue_records), 10):
+            chunk = queue_records[start:start + 10]
+            response = sqs_client.change_message_visibility_batch(
+                QueueUrl = queue_url(source_arn),
+                Entries = [{
+                    "Id": str(i),
+                    "ReceiptHandle": record["receiptHandle"],
+                    "VisibilityTimeout": visibility_timeout,
+                } for i, (record, visibility_timeout) in enumerate(chunk)])
+            for entry in response.get("Failed", []):
+                logging.warning("Could not change visibility of message {}: {}".format(
+                    chunk[int(entry["Id"])][0]["messageId"], entry.get("Code")))
+                failed.append(chunk[int(entry["Id"])][0]["messageId"])
+    return failed
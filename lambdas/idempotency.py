@@ -0,0 +1,106 @@
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import hashlib
+import log_helper
+import os
+import threading
+import time
+from collections import OrderedDict
+
+"""
+Remember the messages the consumer processed, so a message delivered again, after a
+visibility timeout expired or by the at least once delivery of standard queues, is
+acknowledged without running its handler again. IDEMPOTENCY_KEY selects the key:
+  message_id  the SQS message id, a redelivery of the same message
+  payload     a hash of the tenant and the body, also a message sent twice
+Keys are kept for IDEMPOTENCY_TTL seconds in an LRU of IDEMPOTENCY_CACHE_SIZE keys and, when
+IDEMPOTENCY_DB is the path of a SQLite file, also in that file. In Lambda a file in /tmp is
+shared by the invocations of an execution environment, in a container it survives restarts.
+"""
+
+IDEMPOTENCY_KEY = os.environ.get("IDEMPOTENCY_KEY", "message_id")
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", "900"))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "10000"))
+IDEMPOTENCY_DB = os.environ.get("IDEMPOTENCY_DB", "")
+# expired keys are deleted from the file every IDEMPOTENCY_PURGE_INTERVAL seconds
+IDEMPOTENCY_PURGE_INTERVAL = int(os.environ.get("IDEMPOTENCY_PURGE_INTERVAL", "60"))
+
+#key -> time the key expires
+processed = OrderedDict()
+processed_lock = threading.Lock()
+
+#the SQLite connection, opened on first use
+store = {"connection": None, "purged_at": 0}
+store_lock = threading.Lock()
+
+def record_key(record, tenant_id):
+    if IDEMPOTENCY_KEY == "payload":
+        digest = hashlib.blake2b(tenant_id.encode("utf-8") + b"\0", digest_size=16)
+        digest.update(record["body"].encode("utf-8"))
+        return digest.hexdigest()
+    if IDEMPOTENCY_KEY != "message_id":
+        raise ValueError("Unknown idempotency key: {}".format(IDEMPOTENCY_KEY))
+    return record["messageId"]
+
+def get_connection():
+    #called with store_lock held
+    if store["connection"] is None:
+        import sqlite3
+        connection = sqlite3.connect(IDEMPOTENCY_DB, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS processed (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+        store["connection"] = connection
+    return store["connection"]
+
+def is_processed(key):
+    now = time.time()
+    with processed_lock:
+        expires_at = processed.get(key)
+        if expires_at is not None:
+            if expires_at > now:
+                processed.move_to_end(key)
+                return True
+            del processed[key]
+    if not IDEMPOTENCY_DB:
+        return False
+
+    with store_lock:
+        row = get_connection().execute("SELECT expires_at FROM processed WHERE key = ?", (key,)).fetchone()
+    if row is None or row[0] <= now:
+        return False
+    remember(key, row[0])
+    return True
+
+def mark_processed(key):
+    now = time.time()
+    remember(key, now + IDEMPOTENCY_TTL)
+    if not IDEMPOTENCY_DB:
+        return
+    with store_lock:
+        connection = get_connection()
+        connection.execute("INSERT OR REPLACE INTO processed (key, expires_at) VALUES (?, ?)", (key, now + IDEMPOTENCY_TTL))
+        if now - store["purged_at"] > IDEMPOTENCY_PURGE_INTERVAL:
+            deleted = connection.execute("DELETE FROM processed WHERE expires_at <= ?", (now,)).rowcount
+            store["purged_at"] = now
+            log_helper.debug("Purged %d expired keys from %s", deleted, IDEMPOTENCY_DB)
+
+def remember(key, expires_at):
+    with processed_lock:
+        processed[key] = expires_at
+        processed.move_to_end(key)
+        while len(processed) > IDEMPOTENCY_CACHE_SIZE:
+            processed.popitem(last=False)
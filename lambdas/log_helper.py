@@ -0,0 +1,81 @@
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+import logging
+import os
+import threading
+import zlib
+
+"""
+The root logger level is set once from LOG_LEVEL (INFO by default) instead of by the handlers.
+Detail about single requests and messages is logged with debug(), formatted only when it is
+emitted. It is emitted when the level is DEBUG, or when the request or message being processed
+by the thread is sampled: with sample(id, tenant_id) a hash of the request or message id decides,
+so a message is logged at every step or not at all, and the same on each receive. LOG_SAMPLE_RATE is the fraction sampled and
+LOG_SAMPLE_RATES overrides it for tenants, e.g. {"tenant1": 1.0} to follow every request of a tenant.
+"""
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0"))
+LOG_SAMPLE_RATES = json.loads(os.environ.get("LOG_SAMPLE_RATES", "{}"))
+
+logger = logging.getLogger()
+logger.setLevel(LOG_LEVEL)
+
+#sample_id and sampled of the request or message processed by the thread
+state = threading.local()
+
+def sample_rate(tenant_id=None):
+    return LOG_SAMPLE_RATES.get(tenant_id, LOG_SAMPLE_RATE)
+
+def is_sampled(sample_id, tenant_id=None):
+    rate = sample_rate(tenant_id)
+    if rate <= 0 or not sample_id:
+        return False
+    #the same id gets the same decision in every function that processes it
+    return zlib.crc32(sample_id.encode("utf-8")) / 4294967296.0 < rate
+
+class Sample(object):
+    __slots__ = ("previous",)
+
+    def __init__(self, sample_id, tenant_id):
+        self.previous = (getattr(state, "sample_id", None), getattr(state, "sampled", False))
+        state.sample_id = sample_id
+        state.sampled = is_sampled(sample_id, tenant_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        state.sample_id, state.sampled = self.previous
+        return False
+
+def sample(sample_id, tenant_id=None):
+    """Context of a request or message id, for the debug() calls of the thread"""
+    return Sample(sample_id, tenant_id)
+
+def set_tenant(tenant_id):
+    #for requests where the tenant is only known after the token is verified
+    state.sampled = is_sampled(getattr(state, "sample_id", None), tenant_id)
+
+def debug(msg, *args):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(msg, *args)
+    elif getattr(state, "sampled", False):
+        #bypass the level of the logger, the handlers still apply theirs
+        logger.handle(logger.makeRecord(logger.name, logging.DEBUG, "(sampled)", 0,
+            "[%s] " + msg, (state.sample_id,) + args, None))
@@ -1,126 +1,567 @@
+import claim_check
+import clients
 import cognito
+import log_helper
+import queue_selector
+import base64
+import functools
+import hashlib
 import json
-import boto3
 from botocore.exceptions import ClientError
 import time
 import os
 import logging
-import time
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+@functools.lru_cache(maxsize=None)
+def log_settings():
+    #for logging, read on first use so the module can be imported outside of Lambda
+    return {
+        "functionName": os.environ.get("AWS_LAMBDA_FUNCTION_NAME", ""),
+        "functionVersion": os.environ.get("AWS_LAMBDA_FUNCTION_VERSION", ""),
+        "region": os.environ.get("AWS_REGION", ""),
+        "environment": os.environ.get("ENVIRONMENT", ""),
+        "namespace": os.environ.get("NAMESPACE", "sqs-multi-tenancy"),
+    }
+
+# The tenant routing of a service is loaded in bulk from the SSM path /<service>/queue
+# and reloaded after ROUTING_TTL seconds. A tenant missing from the table is looked up
+# on its own and added, so newly onboarded tenants do not wait for the next reload
+ROUTING_TTL = int(os.environ.get("ROUTING_TTL", "300"))
+
+#service_name -> {"tenants": {tenant_id: [queue_url, ...]}, "loaded_at": seconds}
+routing_tables = dict()
+
+# Metrics are buffered and flushed as one EMF document per set of dimensions at the end
+# of the invocation. LOG_EACH_MESSAGE=true also prints a structured entry per message
+LOG_EACH_MESSAGE = os.environ.get("LOG_EACH_MESSAGE", "false").lower() == "true"
+# EMF accepts at most 100 values per metric in a document
+EMF_MAX_VALUES = 100
 
-#for logging
-AWS_LAMBDA_FUNCTION_NAME = os.environ["AWS_LAMBDA_FUNCTION_NAME"]
-AWS_LAMBDA_FUNCTION_VERSION = os.environ["AWS_LAMBDA_FUNCTION_VERSION"]
-AWS_REGION = os.environ["AWS_REGION"]
-ENVIRONMENT = os.environ["ENVIRONMENT"]
-NAMESPACE = os.environ["NAMESPACE"]
+# STAGE_METRICS=true emits the duration of the publish stages as the stageDuration metric
+# by operation, tenant and stage. When it is off span() returns a shared no-op span
+STAGE_METRICS = os.environ.get("STAGE_METRICS", "false").lower() == "true"
+#stage_recorder(stage, duration) also gets the stage durations, set while profiler profiles
+stage_recorder = None
+
+#(dimensions, fields) -> {"counts": {name: total}, "values": {name: [values]}, "units": {name: unit}}
+metric_buffer = dict()
+metric_buffer_lock = threading.Lock()
 
 
 """
 SSM is used to store which queue is used for a tenant for a specific service.  
 In the case a Pool queue is used, its prefix is pool.  This entry is looked up
-in SSM to get list of the pooled queues. Then the queue with the fewest number of messages is chosen
+in SSM to get list of the pooled queues. Then a queue of the pool is chosen by queue_selector.
+The entries of a service are loaded together and kept as a routing table of tenant to queue list.
 """
 
-def send_message(token, claims, account_id, service_name, message_body):
-    sqs_client = boto3.client("sqs")
+# SendMessageBatch accepts at most 10 entries and 256KB in total per call, bodies and attributes
+BATCH_MAX_ENTRIES = 10
+BATCH_MAX_BYTES = 262144
+
+# Bodies of at least ENVELOPE_MIN_BYTES are sent in an envelope compressed with MESSAGE_CODEC
+# (zlib, or zstd when the zstandard package is installed, none to disable). The envelope is
+# one version byte followed by the compressed UTF-8 body, base85 encoded as SQS bodies are
+# text. The codec is named in the message_codec attribute, messages without it are plain
+# text. A body is only enveloped when that makes it smaller
+MESSAGE_CODEC = os.environ.get("MESSAGE_CODEC", "zlib")
+ENVELOPE_MIN_BYTES = int(os.environ.get("ENVELOPE_MIN_BYTES", "1024"))
+ENVELOPE_VERSION = 1
+
+# Queues with a url ending in .fifo are FIFO queues. Messages to them get a MessageGroupId
+# from FIFO_GROUP_KEY: tenant (the tenant id) orders all the messages of a tenant, and
+# tenant_entity orders them per tenant and per the FIFO_ENTITY_FIELD value of a JSON body,
+# so the entities of a tenant are processed in parallel. The MessageDeduplicationId is a hash
+# of the group and the body. A tenant always uses the same queue of a FIFO pool
+FIFO_GROUP_KEY = os.environ.get("FIFO_GROUP_KEY", "tenant")
+FIFO_ENTITY_FIELD = os.environ.get("FIFO_ENTITY_FIELD", "order_id")
+
+# The routing of a message and the exchange of the token for tenant credentials do not
+# depend on each other. When the credentials are not cached the exchange runs on one of
+# PUBLISH_WORKERS threads while the queue is chosen, so the slower of the two is waited for
+PUBLISH_WORKERS = int(os.environ.get("PUBLISH_WORKERS", "4"))
 
+publish_executor = ThreadPoolExecutor(max_workers=PUBLISH_WORKERS)
+
+def send_message(token, claims, account_id, service_name, message_body):
     tenant_id = claims["custom:tenant_id"]
+    # The queue and the SQS client for the session of the Cognito Identity to use for Sending Message
+    queue_url, sqs_tenant_client = get_destination(token, claims, account_id, service_name, "send_message")
+    fifo = fifo_parameters(tenant_id, message_body) if is_fifo(queue_url) else {}
+    message_body, codec, store = prepare_body(token, claims, account_id, message_body, "send_message")
 
-    queues = get_queue_list(tenant_id, service_name)
-    queue_list = queues.split(" ")
-    queue_url = queue_list[0]
-    if len(queue_list) > 1:
-        None
-        #find which queue has fewest messages to prevent noisy neighbor.  This could be made more elaborate
-        i = 0
-        start = time.time()
-        while i < len(queue_list):
-            response = sqs_client.get_queue_attributes(QueueUrl = queue_list[i], AttributeNames = ["All"])
-            #print("response: " + json.dumps(response))
-            numOfMessages = int(response["Attributes"]["ApproximateNumberOfMessages"])
-            logging.info("Queue: {}, Num of Messages: {}".format(queue_list[i], numOfMessages))
-            if i==0:
-                maxNumMessages = numOfMessages
-            else:
-                if numOfMessages < maxNumMessages:
-                    #print("IF 2")
-                    maxNumMessages = numOfMessages
-                    queue_url = queue_list[i]
-                    #print("IF 2: queue_url: ", queue_url)
-            i = i + 1
-        end = time.time()
-        logging.debug("Time spent to check queue is {}".format(end - start))
-    
-
-   # Get the session from the Cognito Identity to use for Sending Message
-    start = time.time()
-    session=cognito.get_session(token, claims, account_id)
-    end = time.time()
-    logging.debug("Session established for the identity in {}".format(end - start))
-
-    # Get sqs resource using the new session  
     # This will fail if the role for the tenant does not have access to the queue
-    logging.info("Send message to queue_url: " + queue_url)
-    sqs_resource = session.resource('sqs')    
-    sqs_queue = sqs_resource.Queue(queue_url)
+    log_helper.debug("Send message to queue_url: %s", queue_url)
 
     #send message
-    response = sqs_queue.send_message( 
-                    MessageBody = message_body,
-                    #MessageDeduplicationId= str(milli_sec) + str(i),
-                    #MessageGroupId=''
-                    MessageAttributes=
-                        {
-                        'tenant_id': {
-                            'StringValue': tenant_id,
-                            'DataType': 'String'
-                            },
-                        'message_version': {
-                            'StringValue': 'Version 1.0',
-                            'DataType': 'String'
-                            }
-                        })
-
-    #log entry for published message for metrics
-    queue_name = queue_url.split("/")[-1]
-    log({
-        "operation": "send_message",
-        "messageId": response["MessageId"],
-        "tenantId": tenant_id,
-        "messageCount" : "1",
-        "queue" : queue_name,
-    }, metrics=["messageCount"], dimensions=["operation", "tenantId"], context=None)    
-
-    logging.info("Message sent to queue: " + queue_url)
+    with span("send", "send_message", tenant_id):
+        response = sqs_tenant_client.send_message(
+                        QueueUrl = queue_url,
+                        MessageBody = message_body,
+                        MessageAttributes = message_attributes(tenant_id, codec, store),
+                        **fifo)
+
+    log_sent_message(tenant_id, queue_url, response["MessageId"])
+
+    log_helper.debug("Message sent to queue: %s", queue_url)
     return response
 
+def send_message_batch(token, claims, account_id, service_name, message_bodies):
+    """
+    Send the messages with SendMessageBatch after routing once for the whole batch.
+    Returns {"successful": [{"index", "messageId"}], "failed": [{"index", "code", "message"}]}
+    where index is the position of the message in message_bodies.
+    For a FIFO queue the messages are sent in order and after a message failed, the messages
+    of its group in the next SendMessageBatch calls are not sent, they fail with the
+    MessageGroupFailed code.
+    """
+    tenant_id = claims["custom:tenant_id"]
+    queue_url, sqs_tenant_client = get_destination(token, claims, account_id, service_name, "send_message_batch")
+
+    log_helper.debug("Send %d messages to queue_url: %s", len(message_bodies), queue_url)
+    successful = []
+    failed = []
+    prepare = functools.partial(prepare_batch_body, token, claims, account_id)
+    if claim_check.CLAIM_CHECK_BUCKET:
+        #the claim checks of large bodies are stored concurrently
+        prepared = list(publish_executor.map(prepare, message_bodies))
+    else:
+        prepared = [prepare(message_body) for message_body in message_bodies]
+    fifo = [fifo_parameters(tenant_id, message_body) for message_body in message_bodies] if is_fifo(queue_url) else None
+    #the groups with a failed message, to keep the order of a FIFO group
+    failed_groups = set()
+    indexes = []
+    for index, (message_body, codec, store) in enumerate(prepared):
+        if isinstance(message_body, ClientError):
+            error = message_body.response.get("Error", {})
+            failed.append({"index": index, "code": error.get("Code", "ClientError"), "message": error.get("Message", str(message_body))})
+            if fifo:
+                failed_groups.add(fifo[index]["MessageGroupId"])
+        elif fifo and fifo[index]["MessageGroupId"] in failed_groups:
+            failed.append(group_failure(index))
+        else:
+            indexes.append(index)
+    attributes = {(codec, store): message_attributes(tenant_id, codec, store) for _, codec, store in prepared}
+    for chunk in batch_chunks([prepared[index][0] for index in indexes],
+                              [attributes[prepared[index][1:]] for index in indexes]):
+        chunk = [indexes[position] for position in chunk]
+        if fifo and failed_groups:
+            failed.extend(group_failure(index) for index in chunk if fifo[index]["MessageGroupId"] in failed_groups)
+            chunk = [index for index in chunk if fifo[index]["MessageGroupId"] not in failed_groups]
+            if not chunk:
+                continue
+        entries = [dict({
+            "Id": str(index),
+            "MessageBody": prepared[index][0],
+            "MessageAttributes": attributes[prepared[index][1:]],
+        }, **(fifo[index] if fifo else {})) for index in chunk]
+        try:
+            with span("send", "send_message_batch", tenant_id):
+                response = sqs_tenant_client.send_message_batch(QueueUrl = queue_url, Entries = entries)
+        except ClientError as err:
+            logging.error(err)
+            error = err.response.get("Error", {})
+            failed.extend({
+                "index": index,
+                "code": error.get("Code", "ClientError"),
+                "message": error.get("Message", str(err)),
+            } for index in chunk)
+            if fifo:
+                failed_groups.update(fifo[index]["MessageGroupId"] for index in chunk)
+            continue
+
+        for entry in response.get("Successful", []):
+            successful.append({"index": int(entry["Id"]), "messageId": entry["MessageId"]})
+            log_sent_message(tenant_id, queue_url, entry["MessageId"])
+        for entry in response.get("Failed", []):
+            failed.append({"index": int(entry["Id"]), "code": entry["Code"], "message": entry.get("Message", "")})
+            if fifo:
+                failed_groups.add(fifo[int(entry["Id"])]["MessageGroupId"])
+
+    log_helper.debug("Sent %d of %d messages to queue: %s", len(successful), len(message_bodies), queue_url)
+    return {
+        "successful": sorted(successful, key=lambda entry: entry["index"]),
+        "failed": sorted(failed, key=lambda entry: entry["index"]),
+    }
+
+def group_failure(index):
+    return {"index": index, "code": "MessageGroupFailed", "message": "A previous message of the group failed"}
+
+def is_fifo(queue_url):
+    return queue_url.endswith(".fifo")
+
+def message_group_id(tenant_id, message_body):
+    if FIFO_GROUP_KEY == "tenant_entity":
+        entity = message_entity(message_body)
+        if entity is not None:
+            group_id = "{}:{}".format(tenant_id, entity)
+            #a group id has at most 128 characters
+            return group_id if len(group_id) <= 128 else hashlib.blake2b(group_id.encode("utf-8"), digest_size=32).hexdigest()
+    return tenant_id
+
+def message_entity(message_body):
+    #the entity of a JSON object body, None for other bodies
+    if not message_body.startswith("{"):
+        return None
+    try:
+        value = json.loads(message_body).get(FIFO_ENTITY_FIELD)
+    except ValueError:
+        return None
+    return None if value is None else str(value)
+
+def fifo_parameters(tenant_id, message_body):
+    """MessageGroupId and MessageDeduplicationId of a message to a FIFO queue"""
+    group_id = message_group_id(tenant_id, message_body)
+    digest = hashlib.blake2b(group_id.encode("utf-8") + b"\0", digest_size=16)
+    digest.update(message_body.encode("utf-8"))
+    return {"MessageGroupId": group_id, "MessageDeduplicationId": digest.hexdigest()}
+
+def prepare_body(token, claims, account_id, message_body, operation):
+    """Returns the body to send, its codec and its claim check store, None when not used"""
+    if claim_check.should_check_in(message_body):
+        tenant_id = claims["custom:tenant_id"]
+        with span("claim_check", operation, tenant_id):
+            s3_tenant_client = cognito.get_s3_client(token, claims, account_id)
+            pointer = claim_check.check_in(s3_tenant_client, tenant_id, message_body)
+        return pointer, None, claim_check.CLAIM_CHECK_STORE
+    message_body, codec = encode_body(message_body)
+    return message_body, codec, None
+
+def prepare_batch_body(token, claims, account_id, message_body):
+    #the error of a failed claim check is returned so only that message fails
+    try:
+        return prepare_body(token, claims, account_id, message_body, "send_message_batch")
+    except ClientError as err:
+        logging.error(err)
+        return err, None, None
+
+def attributes_size(attributes):
+    #SQS counts the name, data type and value of each message attribute in the message size
+    size = 0
+    for name, attribute in attributes.items():
+        value = attribute.get("StringValue")
+        if value is None:
+            value = attribute.get("BinaryValue", b"")
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        size += len(name.encode("utf-8")) + len(attribute["DataType"].encode("utf-8")) + len(value)
+    return size
+
+def batch_chunks(message_bodies, attributes=None):
+    #yield lists of indexes that fit in one SendMessageBatch call, attributes are the
+    #MessageAttributes of each body
+    chunk = []
+    chunk_bytes = 0
+    for index, message_body in enumerate(message_bodies):
+        size = len(message_body.encode("utf-8"))
+        if attributes is not None:
+            size += attributes_size(attributes[index])
+        if chunk and (len(chunk) == BATCH_MAX_ENTRIES or chunk_bytes + size > BATCH_MAX_BYTES):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(index)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+def get_destination(token, claims, account_id, service_name, operation="send_message"):
+    """Returns the queue url and the SQS client of the tenant session to send with"""
+    tenant_id = claims["custom:tenant_id"]
+    if cognito.cached_tenant_session(claims) is not None:
+        #nothing to overlap, a thread would only add latency
+        queue_url = get_queue_url(tenant_id, service_name, operation)
+        return queue_url, get_sqs_client(token, claims, account_id, operation)
+
+    session_future = publish_executor.submit(get_sqs_client, token, claims, account_id, operation)
+    try:
+        queue_url = get_queue_url(tenant_id, service_name, operation)
+    finally:
+        #join the exchange even when routing failed, so it is not left running after the invocation
+        sqs_tenant_client = session_future.result()
+    return queue_url, sqs_tenant_client
+
+def get_sqs_client(token, claims, account_id, operation):
+    with span("session", operation, claims["custom:tenant_id"]):
+        return cognito.get_sqs_client(token, claims, account_id)
+
+def get_queue_url(tenant_id, service_name, operation="send_message"):
+    with span("routing", operation, tenant_id):
+        queue_list = get_queue_list(tenant_id, service_name)
+    #find which queue of a pool to use to prevent noisy neighbor, see queue_selector for the strategies
+    with span("queue_depth", operation, tenant_id):
+        queue_url = queue_selector.select_queue(clients.get_client("sqs"), queue_list, tenant_id=tenant_id)
+    return queue_url
+
+def message_attributes(tenant_id, codec=None, store=None):
+    attributes = {
+        'tenant_id': {
+            'StringValue': tenant_id,
+            'DataType': 'String'
+            },
+        'message_version': {
+            'StringValue': 'Version 1.0',
+            'DataType': 'String'
+            }
+        }
+    if codec is not None:
+        attributes['message_codec'] = {
+            'StringValue': codec,
+            'DataType': 'String'
+            }
+    if store is not None:
+        attributes['claim_check'] = {
+            'StringValue': store,
+            'DataType': 'String'
+            }
+    return attributes
+
+def zstd_compress(data):
+    import zstandard
+    return zstandard.ZstdCompressor().compress(data)
+
+def zstd_decompress(data):
+    import zstandard
+    return zstandard.ZstdDecompressor().decompress(data)
+
+#codec name -> (compress, decompress)
+codecs = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "zstd": (zstd_compress, zstd_decompress),
+}
+
+def encode_body(message_body, codec=None):
+    """Returns the body to send and the codec to name in message_codec, None for plain text"""
+    codec = codec or MESSAGE_CODEC
+    if codec == "none" or len(message_body) < ENVELOPE_MIN_BYTES / 4:
+        return message_body, None
+    if codec not in codecs:
+        raise ValueError("Unknown message codec: {}".format(codec))
+    data = message_body.encode("utf-8")
+    if len(data) < ENVELOPE_MIN_BYTES:
+        return message_body, None
+    try:
+        compressed = codecs[codec][0](data)
+    except ImportError:
+        logging.warning("Codec %s is not available, sending plain text", codec)
+        return message_body, None
+    envelope = base64.b85encode(bytes([ENVELOPE_VERSION]) + compressed).decode("ascii")
+    if len(envelope) >= len(data):
+        return message_body, None
+    return envelope, codec
+
+def decode_body(body, message_attributes):
+    """Decode the body of a received message, message_attributes in the Lambda record format"""
+    codec_attribute = message_attributes.get("message_codec")
+    if codec_attribute is None:
+        return body
+    codec = codec_attribute["stringValue"]
+    if codec not in codecs:
+        raise ValueError("Unknown message codec: {}".format(codec))
+    envelope = base64.b85decode(body)
+    if envelope[0] != ENVELOPE_VERSION:
+        raise ValueError("Unsupported envelope version: {}".format(envelope[0]))
+    return codecs[codec][1](envelope[1:]).decode("utf-8")
+
+def log_sent_message(tenant_id, queue_url, message_id):
+    count_message("send_message", tenant_id, queue_url.split("/")[-1], message_id)
+
 def get_queue_list(tenant_id, service_name):
-    ssm_client = boto3.client("ssm")
+    routing_table = get_routing_table(service_name)
+    queue_list = routing_table["tenants"].get(tenant_id)
+    if queue_list is None:
+        queue_list = load_tenant_route(routing_table, tenant_id, service_name)
+    return queue_list
+
+def get_routing_table(service_name):
+    routing_table = routing_tables.get(service_name)
+    if routing_table is None or time.time() - routing_table["loaded_at"] > ROUTING_TTL:
+        try:
+            routing_table = load_routing_table(service_name)
+        except (ClientError, ValueError) as err:
+            if routing_table is None:
+                raise
+            #keep routing with the table we have until the next reload
+            logging.error(err)
+            routing_table["loaded_at"] = time.time()
+            return routing_table
+        routing_tables[service_name] = routing_table
+    return routing_table
+
+def load_routing_table(service_name):
+    ssm_client = clients.get_client("ssm")
+    #Get all the queue entries of the service using path of service_name
+    path = "/{}/queue".format(service_name)
+    parameters = dict()
+    paginator = ssm_client.get_paginator("get_parameters_by_path")
+    for page in paginator.paginate(Path = path):
+        for parameter in page["Parameters"]:
+            parameters[parameter["Name"]] = parameter["Value"]
+
+    tenants = dict()
+    pools = dict()
+    for name, ssm_value in parameters.items():
+        #If queue name has pool then the entry is the name of the list of pool queue names
+        if ssm_value.endswith("pool"):
+            if ssm_value not in pools:
+                try:
+                    pools[ssm_value] = parameters.get(ssm_value) or get_parameter_value(ssm_client, ssm_value)
+                except ValueError:
+                    #only the tenants of this pool are left out, load_tenant_route fails for them
+                    logging.error("Pool %s of %s could not be resolved", ssm_value, name)
+                    pools[ssm_value] = None
+            ssm_value = pools[ssm_value]
+            if ssm_value is None:
+                continue
+        tenants[name.rsplit("/", 1)[-1]] = ssm_value.split()
+
+    #the pool lists themselves are not tenants
+    for pool_name in pools:
+        tenants.pop(pool_name.rsplit("/", 1)[-1], None)
+
+    logging.info("Loaded routing for %d tenants from %s", len(tenants), path)
+    return {"tenants": tenants, "loaded_at": time.time()}
+
+def load_tenant_route(routing_table, tenant_id, service_name):
+    ssm_client = clients.get_client("ssm")
     #Get the queue name from SSM for this service using path of service_name/tenant_id
     path = "/{}/queue/{}".format(service_name,tenant_id)
-    #print("Path: ", path)
+    ssm_value = get_parameter_value(ssm_client, path)
+    #If queue name has pool then lookup the list of pool queue names
+    if ssm_value.endswith("pool"):
+        ssm_value = get_parameter_value(ssm_client, ssm_value)
+
+    queue_list = ssm_value.split()
+    routing_table["tenants"][tenant_id] = queue_list
+    return queue_list
+
+def get_parameter_value(ssm_client, path):
     try:
         queue_ssm = ssm_client.get_parameter(Name = path)
     except ClientError as err:
         logging.error(err)
         raise ValueError("No SSM Parameter found for path: {}".format(path))
+    return queue_ssm["Parameter"]["Value"]
 
-    #print("queue_ssm:", queue_ssm)
-    ssm_value = queue_ssm["Parameter"]["Value"]
-    #If queue name has pool then lookup the list of pool queue names
-    if ssm_value.endswith("pool"):
-        #get the list of queues for pool
+def count_message(operation, tenant_id, queue_name, message_id):
+    #messageCount by operation and tenant, the queue is kept as a field for the insight rules
+    put_count("messageCount", {"operation": operation, "tenantId": tenant_id}, fields={"queue": queue_name})
+    if LOG_EACH_MESSAGE:
+        #no messageCount field, the insight rules sum it over every log line and would count the message twice
+        log({
+            "operation": operation,
+            "messageId": message_id,
+            "tenantId": tenant_id,
+            "queue" : queue_name,
+        })
+
+def put_count(name, dimensions, count=1, fields=None):
+    with metric_buffer_lock:
+        entry = get_metric_entry(dimensions, fields)
+        entry["counts"][name] = entry["counts"].get(name, 0) + count
+        entry["units"][name] = "None"
+
+def put_value(name, value, dimensions, unit="None", fields=None):
+    with metric_buffer_lock:
+        entry = get_metric_entry(dimensions, fields)
+        entry["values"].setdefault(name, []).append(value)
+        entry["units"][name] = unit
+
+def get_metric_entry(dimensions, fields):
+    #called with metric_buffer_lock held
+    key = (tuple(dimensions.items()), tuple((fields or {}).items()))
+    entry = metric_buffer.get(key)
+    if entry is None:
+        entry = metric_buffer[key] = {"counts": dict(), "values": dict(), "units": dict()}
+    return entry
+
+class Span(object):
+    __slots__ = ("stage", "operation", "tenant_id", "start")
+
+    def __init__(self, stage, operation, tenant_id):
+        self.stage = stage
+        self.operation = operation
+        self.tenant_id = tenant_id
+
+    def set_tenant(self, tenant_id):
+        #for stages where the tenant is only known at the end, like token verification
+        self.tenant_id = tenant_id
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        #only completed stages are recorded
+        if exc_type is None:
+            duration = (time.perf_counter() - self.start) * 1000
+            if STAGE_METRICS:
+                put_value("stageDuration", duration, {
+                    "operation": self.operation,
+                    "tenantId": self.tenant_id or "none",
+                    "stage": self.stage,
+                }, unit="Milliseconds")
+            recorder = stage_recorder
+            if recorder is not None:
+                recorder(self.stage, duration)
+        return False
+
+class NullSpan(object):
+    __slots__ = ()
+
+    def set_tenant(self, tenant_id):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_SPAN = NullSpan()
+
+def span(stage, operation, tenant_id=None):
+    if not STAGE_METRICS and stage_recorder is None:
+        return NULL_SPAN
+    return Span(stage, operation, tenant_id)
+
+def flush_metrics(context=None):
+    global metric_buffer
+    with metric_buffer_lock:
+        buffer = metric_buffer
+        metric_buffer = dict()
+
+    for (dimensions, fields), entry in buffer.items():
+        values = entry["values"]
+        #counts go out once, values in slices of at most EMF_MAX_VALUES per document
+        chunks = max([len(v) for v in values.values()] + [1])
+        for start in range(0, chunks, EMF_MAX_VALUES):
+            item = dict(fields)
+            item.update(dimensions)
+            if start == 0:
+                item.update(entry["counts"])
+            for name, metric_values in values.items():
+                if metric_values[start:start + EMF_MAX_VALUES]:
+                    item[name] = metric_values[start:start + EMF_MAX_VALUES]
+            metrics = [name for name in entry["units"] if name in item]
+            log(item, metrics=metrics, dimensions=[name for name, _ in dimensions],
+                context=context, units=entry["units"])
+
+def metrics_flushed(handler):
+    #decorator for a lambda handler to flush the buffered metrics when the invocation ends
+    @functools.wraps(handler)
+    def wrapper(event, context):
         try:
-            queue_ssm = ssm_client.get_parameter(Name = ssm_value)
-        except ClientError as err:
-            raise ValueError("No SSM Parameter found for path: {}".format(queue_ssm))
-        #print("queue_ssm:", queue_ssm)
-        ssm_value = queue_ssm["Parameter"]["Value"]
+            return handler(event, context)
+        finally:
+            flush_metrics(context)
 
-    #print("ssm value: ", ssm_value)
-    return ssm_value
+    return wrapper
 
-def log(item, metrics=None, dimensions=None, context=None):
+def log(item, metrics=None, dimensions=None, context=None, units=None):
     if not isinstance(item, dict):
         print(item)
         return
@@ -128,13 +569,14 @@ def log(item, metrics=None, dimensions=None, context=None):
     if "loglevel" not in item:
         item["loglevel"] = "INFO"
 
+    settings = log_settings()
     if metrics:
         item["_aws"] = {
             "Timestamp": int(time.time()*1000),
             "CloudWatchMetrics": [{
-                "Namespace": NAMESPACE,
+                "Namespace": settings["namespace"],
                 "Dimensions": [(dimensions or [])+["environment"]],
-                "Metrics": [{"Name": m, "Unit": "None"} for m in metrics]
+                "Metrics": [{"Name": m, "Unit": (units or {}).get(m, "None")} for m in metrics]
             }]
         }
 
@@ -143,10 +585,10 @@ def log(item, metrics=None, dimensions=None, context=None):
     #     for dimension in dimensions or []:
     #         subsegment.put_annotation(dimension, item[dimension])
 
-    item["environment"] = ENVIRONMENT
-    item["functionName"] = AWS_LAMBDA_FUNCTION_NAME
-    item["functionVersion"] = AWS_LAMBDA_FUNCTION_VERSION
-    item["region"] = AWS_REGION
+    item["environment"] = settings["environment"]
+    item["functionName"] = settings["functionName"]
+    item["functionVersion"] = settings["functionVersion"]
+    item["region"] = settings["region"]
 
     # xray_trace_id = os.environ.get("_X_AMZN_TRACE_ID", "")
 
@@ -166,13 +608,13 @@ if __name__ == '__main__':
 
     #you can use https://jwt.io to get the ciams from a token to build the Claims JSON
     tenant1_token = "eyJraWQiOiJlU1F5bmNaZERndFM4UnFzXC83K0ZcL3Q3Zlg1WWlRWHBOR2hLWkhQOU5cL1wvZz0iLCJhbGciOiJSUzI1NiJ9.eyJzdWIiOiJhZjY1OTczYS0xYjdmLTQ4Y2QtYTg1ZS1kYmEwMzYzZGE0MjUiLCJhdWQiOiIybG5iODZrb2xmcjBpZXM4M3JtcTNjczA2dCIsImN1c3RvbTppZGVudGl0eV9wb29sIjoidXMtd2VzdC0yOmI3OTVkNTllLTIwMmYtNGU1Yi1hZGY3LTQzZGNiMWQzZTQ5MCIsImV2ZW50X2lkIjoiNThmYzZmZWUtNDZmMy00ZDdkLTkwYzctYTFjYTY5YjdhZWFhIiwidG9rZW5fdXNlIjoiaWQiLCJhdXRoX3RpbWUiOjE1OTExNTk2NDksImlzcyI6Imh0dHBzOlwvXC9jb2duaXRvLWlkcC51cy13ZXN0LTIuYW1hem9uYXdzLmNvbVwvdXMtd2VzdC0yX0dCaEtvU1BJaCIsImNvZ25pdG86dXNlcm5hbWUiOiJ1c2VyQHRlbmFudDEuY29tIiwiY3VzdG9tOnRlbmFudF9pZCI6InRlbmFudDEiLCJleHAiOjE1OTExNjMyNDksImlhdCI6MTU5MTE1OTY0OX0.kqjXllXBWePkfCNTJ-qV28JuDrn_VaCtPQmwxpp4fpjefrA3PzMU_TIBlWrnVqegkMSl2CCkMI1e5UcnNGr0KpCrsktykFMxxt1-pJAlq7KTCSaIGGDhXEdXdUOaan-wOBMzESXbpSqTRo_y64GCUMaKapfT677OH1y2_COok0KWkG0oLQapFY4__QH8md8hzqG28fEsljLFkKWlXhA6oiX7OK_VlWFWbjZkLL-IW7LFYPxBa76O5l0stsvl1Yrkw51wqWGkOECjocPRr3BMr6IQkkmG2ZgbcWU9PSvtO1TJ6kdAZXrlqP7_yvardxg79Zg6RRfMsL6xXWX-Ly3NfQ"
-    claims1 = json.loads('{"custom:tenant_id":"tenant1", "custom:identity_pool":"us-west-2:b795d59e-202f-4e5b-adf7-43dcb1d3e490", "iss":"https://cognito-idp.us-west-2.amazonaws.com/us-west-2_GBhKoSPIh"}')
+    claims1 = json.loads('{"sub":"af65973a-1b7f-48cd-a85e-dba0363da425", "custom:tenant_id":"tenant1", "custom:identity_pool":"us-west-2:b795d59e-202f-4e5b-adf7-43dcb1d3e490", "iss":"https://cognito-idp.us-west-2.amazonaws.com/us-west-2_GBhKoSPIh"}')
     send_message(tenant1_token,
         claims1, "094057127497", "order", "Test message")
 
 
     #you can use https://jwt.io to get the ciams from a token to build the Claims JSON
     tenant2_token = "eyJraWQiOiJxMGJFbU91c3hUM09TV0dQMFNCYWtoaDNhcE9XVWRnOVV4R3dhTXE4eEUwPSIsImFsZyI6IlJTMjU2In0.eyJzdWIiOiJjOGQ2Y2E4Yi1jMTkxLTQzZjQtOWIyNC0yYWVmMzBiNDNmMjgiLCJhdWQiOiI2OXB1a3U4NW1kcjlwaTNmc2xhZ3A1YjVldiIsImN1c3RvbTppZGVudGl0eV9wb29sIjoidXMtd2VzdC0yOmRlMTZhNzMzLTRmODYtNGU4OC04NGY3LWE0NTdjNDdiMDA5OCIsImV2ZW50X2lkIjoiZTYxYzRiNWQtODc4ZC00NTZiLWJmZWEtZGY2ZmNhYmYwN2Q2IiwidG9rZW5fdXNlIjoiaWQiLCJhdXRoX3RpbWUiOjE1OTExNjA4NDgsImlzcyI6Imh0dHBzOlwvXC9jb2duaXRvLWlkcC51cy13ZXN0LTIuYW1hem9uYXdzLmNvbVwvdXMtd2VzdC0yX29STEwwN29xZCIsImNvZ25pdG86dXNlcm5hbWUiOiJ1c2VyQHRlbmFudDIuY29tIiwiY3VzdG9tOnRlbmFudF9pZCI6InRlbmFudDIiLCJleHAiOjE1OTExNjQ0NDgsImlhdCI6MTU5MTE2MDg0OH0.lbNTG4q6PNjIfsonDp4H3Puzaeltznt2ZuIqj4jyXWs1fyeVJkkGVOn9YJbtZSg5pCGBSGegZQ4pwcfAkpU_nTxSS8J2jxUMq0lL2Tr-lELfI-BsNZ-hri1pcNF_54ZUORcRO3eg0Qp1wkYMmOF_vJmwmeBNToICPULM0R-7jdibz0PmeXrvN2QhkRnR9_vLTCS2r9gG5i_E_OwvS4zHAxM1_uBM73tURmhmWdTG7-ml2mmqYCfioNHKx1G8nOiZwMNlojyhlnw-e1TzJYmZTR3HaNHxzBG8QTj_lG_eRAMDxGiayNaTMyeH9CX3vFjuTX5nyig2cmB1i3J7PrXTEw"
-    claims2 = json.loads('{"custom:tenant_id":"tenant2", "custom:identity_pool":"us-west-2:de16a733-4f86-4e88-84f7-a457c47b0098", "iss":"https://cognito-idp.us-west-2.amazonaws.com/us-west-2_oRLL07oqd"}')
+    claims2 = json.loads('{"sub":"c8d6ca8b-c191-43f4-9b24-2aef30b43f28", "custom:tenant_id":"tenant2", "custom:identity_pool":"us-west-2:de16a733-4f86-4e88-84f7-a457c47b0098", "iss":"https://cognito-idp.us-west-2.amazonaws.com/us-west-2_oRLL07oqd"}')
     send_message(tenant2_token,
         claims2, "094057127497", "order", "Test message tenant 2")
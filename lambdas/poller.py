@@ -0,0 +1,200 @@
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import argparse
+import asyncio
+import functools
+import logging
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+import clients
+import consumer
+import log_helper
+import message_helper
+
+"""
+Long running consumer for containers, an alternative to the Lambda event source mappings.
+The queues are discovered from the same SSM routing entries message_helper publishes with
+(/<service>/queue/*) and rediscovered every POLLER_DISCOVERY_INTERVAL seconds. Every queue
+is long polled for up to 10 messages at a time, the records go through consumer.process_batch
+like in the Lambda consumer, and the processed messages are deleted in batches. At most
+POLLER_MAX_IN_FLIGHT batches are processed at once, a queue keeps receiving while its previous
+batch is processed. A queue only waits for a processing slot once it received messages, so idle
+queues never hold one. The long polls run on their own POLLER_MAX_RECEIVES threads, with more
+queues than that the receives of the others wait for a thread. SIGTERM or SIGINT stops receiving, the batches in flight are finished and
+the metrics are flushed before exiting.
+
+  python3 poller.py --service order
+"""
+
+POLLER_WAIT_SECONDS = int(os.environ.get("POLLER_WAIT_SECONDS", "20"))
+POLLER_MAX_IN_FLIGHT = int(os.environ.get("POLLER_MAX_IN_FLIGHT", "8"))
+POLLER_MAX_RECEIVES = int(os.environ.get("POLLER_MAX_RECEIVES", "64"))
+POLLER_DISCOVERY_INTERVAL = int(os.environ.get("POLLER_DISCOVERY_INTERVAL", "60"))
+POLLER_METRICS_INTERVAL = int(os.environ.get("POLLER_METRICS_INTERVAL", "60"))
+
+def discover_queues(service_name):
+    routing_table = message_helper.get_routing_table(service_name)
+    queue_urls = set()
+    for queue_list in routing_table["tenants"].values():
+        queue_urls.update(queue_list)
+    return queue_urls
+
+def queue_arn(queue_url):
+    #https://sqs.<region>.amazonaws.com/<account>/<queue name>
+    parts = queue_url.split("/")
+    region = parts[2].split(".")[1]
+    return "arn:aws:sqs:{}:{}:{}".format(region, parts[3], parts[4])
+
+def to_record(message, queue_url):
+    #the record format of the SQS event Lambda receives, so the consumer logic can be reused
+    return {
+        "messageId": message["MessageId"],
+        "receiptHandle": message["ReceiptHandle"],
+        "body": message["Body"],
+        "attributes": message.get("Attributes", {}),
+        "messageAttributes": {
+            name: {
+                "stringValue": value.get("StringValue"),
+                "binaryValue": value.get("BinaryValue"),
+                "dataType": value["DataType"],
+            } for name, value in message.get("MessageAttributes", {}).items()
+        },
+        "md5OfBody": message.get("MD5OfBody"),
+        "eventSource": "aws:sqs",
+        "eventSourceARN": queue_arn(queue_url),
+    }
+
+class Poller(object):
+
+    def __init__(self, service_name):
+        self.service_name = service_name
+        self.stopping = None
+        self.in_flight = None
+        self.pollers = dict()
+        self.batches = set()
+        self.executor = ThreadPoolExecutor(max_workers=POLLER_MAX_IN_FLIGHT + 16)
+        #the long polls wait up to POLLER_WAIT_SECONDS, they do not take the threads of the batches
+        self.receive_executor = ThreadPoolExecutor(max_workers=POLLER_MAX_RECEIVES)
+
+    async def call(self, function, *args, **kwargs):
+        #boto3 is blocking, its calls run on the executor
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    async def receive(self, sqs_client, queue_url):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.receive_executor, functools.partial(sqs_client.receive_message,
+            QueueUrl = queue_url,
+            MaxNumberOfMessages = 10,
+            WaitTimeSeconds = POLLER_WAIT_SECONDS,
+            AttributeNames = ["All"],
+            MessageAttributeNames = ["All"]))
+
+    async def run(self):
+        self.stopping = asyncio.Event()
+        self.in_flight = asyncio.Semaphore(POLLER_MAX_IN_FLIGHT)
+        loop = asyncio.get_event_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stopping.set)
+
+        metrics = asyncio.ensure_future(self.flush_metrics())
+        while not self.stopping.is_set():
+            await self.discover()
+            try:
+                await asyncio.wait_for(self.stopping.wait(), POLLER_DISCOVERY_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+        logging.info("Stopping, waiting for {} queue pollers and {} batches".format(len(self.pollers), len(self.batches)))
+        await asyncio.gather(*self.pollers.values(), return_exceptions=True)
+        await asyncio.gather(*list(self.batches), return_exceptions=True)
+        metrics.cancel()
+        message_helper.flush_metrics()
+        self.executor.shutdown()
+        self.receive_executor.shutdown()
+
+    async def discover(self):
+        try:
+            queue_urls = await self.call(discover_queues, self.service_name)
+        except Exception:
+            logging.exception("Queue discovery failed")
+            return
+        for queue_url in queue_urls - set(self.pollers):
+            logging.info("Polling queue {}".format(queue_url))
+            self.pollers[queue_url] = asyncio.ensure_future(self.poll(queue_url))
+        for queue_url in set(self.pollers) - queue_urls:
+            logging.info("Queue {} is no longer routed, stop polling".format(queue_url))
+            self.pollers.pop(queue_url).cancel()
+
+    async def poll(self, queue_url):
+        sqs_client = clients.get_client("sqs")
+        while not self.stopping.is_set():
+            try:
+                response = await self.receive(sqs_client, queue_url)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception("Receive from {} failed".format(queue_url))
+                await asyncio.sleep(1)
+                continue
+
+            messages = response.get("Messages", [])
+            if not messages:
+                continue
+            #the queue stops receiving until a batch slot is free, the messages stay invisible meanwhile
+            await self.in_flight.acquire()
+            #process the batch while the next one is received
+            batch = asyncio.ensure_future(self.process(queue_url, [to_record(m, queue_url) for m in messages]))
+            self.batches.add(batch)
+            batch.add_done_callback(self.batches.discard)
+
+    async def process(self, queue_url, records):
+        try:
+            failures = await self.call(consumer.process_batch, records)
+            failed = set(failure["itemIdentifier"] for failure in failures)
+            done = [record for record in records if record["messageId"] not in failed]
+            if done:
+                await self.call(delete_records, queue_url, done)
+        except Exception:
+            logging.exception("Processing a batch of {} failed".format(queue_url))
+        finally:
+            self.in_flight.release()
+
+    async def flush_metrics(self):
+        while True:
+            await asyncio.sleep(POLLER_METRICS_INTERVAL)
+            message_helper.flush_metrics()
+
+def delete_records(queue_url, records):
+    sqs_client = clients.get_client("sqs")
+    response = sqs_client.delete_message_batch(
+        QueueUrl = queue_url,
+        Entries = [{"Id": str(i), "ReceiptHandle": record["receiptHandle"]} for i, record in enumerate(records)])
+    for entry in response.get("Failed", []):
+        logging.warning("Could not delete message {}: {}".format(records[int(entry["Id"])]["messageId"], entry.get("Code")))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--service", default="order")
+    args = parser.parse_args()
+    logging.basicConfig(level=log_helper.LOG_LEVEL)
+    asyncio.run(Poller(args.service).run())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import message_helper
+
+"""
+Opt-in profiling of the Lambda handlers. With PROFILE_ENABLED=true every invocation is profiled,
+with PROFILE_SAMPLE_RATE a random fraction of them. A profiled invocation runs under cProfile
+and tracemalloc, and a compact summary is written as JSON to PROFILE_DIR and to the log:
+the PROFILE_TOP functions by cumulative time, the PROFILE_TOP allocation sites by size still
+allocated at the end of the invocation, the peak traced memory and the duration of each stage
+recorded with message_helper.span. cProfile only sees the thread of the handler, the work of the
+executor threads shows as time waiting on their futures. When neither setting is on, profiled()
+returns the handler itself, so the disabled profiler costs nothing per invocation.
+"""
+
+PROFILE_ENABLED = os.environ.get("PROFILE_ENABLED", "false").lower() == "true"
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/profiles")
+PROFILE_TOP = int(os.environ.get("PROFILE_TOP", "15"))
+PROFILE_TRACEMALLOC_FRAMES = int(os.environ.get("PROFILE_TRACEMALLOC_FRAMES", "1"))
+#the oldest summaries are removed so /tmp does not fill up on a warm container
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", "50"))
+
+#one invocation is profiled at a time, cProfile and tracemalloc are process wide
+profile_lock = threading.Lock()
+
+class Profile(object):
+
+    def __init__(self, name, request_id):
+        #the profiling modules are only imported for a profiled invocation, not on cold start
+        import cProfile
+        self.name = name
+        self.request_id = request_id
+        self.profiler = cProfile.Profile()
+        #stage -> [count, total milliseconds]
+        self.stages = dict()
+        self.stages_lock = threading.Lock()
+
+    def add_stage(self, stage, duration):
+        with self.stages_lock:
+            totals = self.stages.setdefault(stage, [0, 0.0])
+            totals[0] += 1
+            totals[1] += duration
+
+    def run(self, handler, event, context):
+        import tracemalloc
+        started_tracing = not tracemalloc.is_tracing()
+        baseline = None
+        if started_tracing:
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+        else:
+            #tracing was started by PYTHONTRACEMALLOC, only the difference is reported
+            baseline = tracemalloc.take_snapshot()
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+        message_helper.stage_recorder = self.add_stage
+        start = time.perf_counter()
+        self.profiler.enable()
+        try:
+            return handler(event, context)
+        finally:
+            self.profiler.disable()
+            self.duration = (time.perf_counter() - start) * 1000
+            message_helper.stage_recorder = None
+            snapshot = tracemalloc.take_snapshot()
+            self.peak = tracemalloc.get_traced_memory()[1]
+            if started_tracing:
+                tracemalloc.stop()
+            self.allocations = self.allocation_sites(snapshot, baseline)
+
+    def allocation_sites(self, snapshot, baseline):
+        import tracemalloc
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)])
+        if baseline is None:
+            statistics = snapshot.statistics("lineno")
+        else:
+            statistics = snapshot.compare_to(baseline, "lineno")
+        sites = []
+        for statistic in statistics[:PROFILE_TOP]:
+            frame = statistic.traceback[0]
+            sites.append({
+                "site": "{}:{}".format(frame.filename, frame.lineno),
+                "sizeKB": round(getattr(statistic, "size_diff", statistic.size) / 1024.0, 1),
+                "count": getattr(statistic, "count_diff", statistic.count),
+            })
+        return sites
+
+    def functions(self):
+        import pstats
+        stats = pstats.Stats(self.profiler)
+        #(file, line, function) -> (primitive calls, calls, total time, cumulative time, callers)
+        ranked = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+        return [{
+            "function": "{}:{}({})".format(filename, line, function),
+            "calls": calls,
+            "totalMs": round(total_time * 1000, 3),
+            "cumulativeMs": round(cumulative_time * 1000, 3),
+        } for (filename, line, function), (_, calls, total_time, cumulative_time, _) in ranked[:PROFILE_TOP]]
+
+    def summary(self):
+        return {
+            "profile": self.name,
+            "profileRequestId": self.request_id,
+            "durationMs": round(self.duration, 3),
+            "peakMemoryKB": round(self.peak / 1024.0, 1),
+            "stages": {stage: {"count": count, "totalMs": round(total, 3)}
+                       for stage, (count, total) in self.stages.items()},
+            "functions": self.functions(),
+            "allocations": self.allocations,
+        }
+
+def write_summary(summary):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, "{}-{}-{}.json".format(
+        summary["profile"], int(time.time() * 1000), summary["profileRequestId"] or "local"))
+    with open(path, "w") as summary_file:
+        json.dump(summary, summary_file, indent=1)
+    summaries = sorted(os.path.join(PROFILE_DIR, name) for name in os.listdir(PROFILE_DIR) if name.endswith(".json"))
+    for old_path in summaries[:-PROFILE_MAX_FILES] if PROFILE_MAX_FILES > 0 else []:
+        os.remove(old_path)
+    return path
+
+def is_profiled():
+    return PROFILE_ENABLED or random.random() < PROFILE_SAMPLE_RATE
+
+def profiled(handler):
+    #decorator for a lambda handler, the handler is returned as is when profiling is off
+    if not PROFILE_ENABLED and PROFILE_SAMPLE_RATE <= 0:
+        return handler
+    name = "{}.{}".format(handler.__module__, handler.__name__)
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        if not is_profiled() or not profile_lock.acquire(blocking=False):
+            return handler(event, context)
+        try:
+            profile = Profile(name, getattr(context, "aws_request_id", None))
+            try:
+                return profile.run(handler, event, context)
+            finally:
+                try:
+                    summary = profile.summary()
+                    summary["summaryFile"] = write_summary(summary)
+                    message_helper.log(summary, context=context)
+                except Exception:
+                    #profiling never fails the invocation
+                    logging.exception("Could not write the profile of %s", name)
+        finally:
+            profile_lock.release()
+
+    return wrapper
@@ -0,0 +1,135 @@
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import functools
+import hashlib
+import itertools
+import log_helper
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Choose the queue of a pool to publish to, to prevent a noisy neighbor from filling one queue.
+The depth of the pool queues is probed concurrently and a depth younger than QUEUE_DEPTH_MAX_AGE
+seconds is reused. POOL_STRATEGY selects how the queue is picked from the depths:
+  least_depth      the queue with the fewest messages
+  power_of_two     the less loaded of two queues chosen at random, probing only those two
+  weighted_random  a random queue, weighted towards queues with fewer messages
+  shuffle_shard    rotate over a stable shard of POOL_SHARD_SIZE queues of the tenant,
+                   without any call to SQS
+A FIFO pool is never balanced, each tenant always sends to its own queue of the pool.
+The shard of a tenant is chosen by rendezvous hashing: the queues with the highest hash of
+tenant and queue url. Tenants share few of their queues with any other tenant, so a noisy
+tenant only fills its own shard, and adding or removing a queue of the pool only moves the
+tenants whose shard contained or now contains that queue.
+"""
+
+POOL_STRATEGY = os.environ.get("POOL_STRATEGY", "least_depth")
+QUEUE_DEPTH_MAX_AGE = float(os.environ.get("QUEUE_DEPTH_MAX_AGE", "1"))
+QUEUE_PROBE_WORKERS = int(os.environ.get("QUEUE_PROBE_WORKERS", "10"))
+POOL_SHARD_SIZE = int(os.environ.get("POOL_SHARD_SIZE", "2"))
+SHARD_CACHE_SIZE = int(os.environ.get("SHARD_CACHE_SIZE", "4096"))
+
+#queue_url -> (number of messages, time of probe)
+depth_cache = dict()
+depth_cache_lock = threading.Lock()
+probe_executor = ThreadPoolExecutor(max_workers=QUEUE_PROBE_WORKERS)
+
+def probe_depth(sqs_client, queue_url):
+    response = sqs_client.get_queue_attributes(QueueUrl = queue_url, AttributeNames = ["ApproximateNumberOfMessages"])
+    numOfMessages = int(response["Attributes"]["ApproximateNumberOfMessages"])
+    with depth_cache_lock:
+        depth_cache[queue_url] = (numOfMessages, time.time())
+    log_helper.debug("Queue: %s, Num of Messages: %d", queue_url, numOfMessages)
+    return numOfMessages
+
+def get_depths(sqs_client, queue_list):
+    depths = dict()
+    stale = []
+    now = time.time()
+    for queue_url in queue_list:
+        cached = depth_cache.get(queue_url)
+        if cached is not None and now - cached[1] <= QUEUE_DEPTH_MAX_AGE:
+            depths[queue_url] = cached[0]
+        else:
+            stale.append(queue_url)
+
+    if len(stale) == 1:
+        depths[stale[0]] = probe_depth(sqs_client, stale[0])
+    elif stale:
+        futures = [(queue_url, probe_executor.submit(probe_depth, sqs_client, queue_url)) for queue_url in stale]
+        for queue_url, future in futures:
+            depths[queue_url] = future.result()
+    return depths
+
+def least_depth(sqs_client, queue_list, tenant_id=None):
+    depths = get_depths(sqs_client, queue_list)
+    #min keeps the first of equally loaded queues
+    return min(queue_list, key=lambda queue_url: depths[queue_url])
+
+def power_of_two(sqs_client, queue_list, tenant_id=None):
+    candidates = random.sample(queue_list, 2)
+    depths = get_depths(sqs_client, candidates)
+    return min(candidates, key=lambda queue_url: depths[queue_url])
+
+def weighted_random(sqs_client, queue_list, tenant_id=None):
+    depths = get_depths(sqs_client, queue_list)
+    weights = [1.0 / (depths[queue_url] + 1) for queue_url in queue_list]
+    return random.choices(queue_list, weights=weights)[0]
+
+def rendezvous_score(tenant_id, queue_url):
+    digest = hashlib.md5("{}|{}".format(tenant_id, queue_url).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big")
+
+@functools.lru_cache(maxsize=SHARD_CACHE_SIZE)
+def tenant_shard(tenant_id, queues, shard_size):
+    """The queues of the shard of the tenant, queues is the tuple of the pool queue urls"""
+    ranked = sorted(queues, key=lambda queue_url: rendezvous_score(tenant_id, queue_url), reverse=True)
+    return tuple(ranked[:max(1, shard_size)])
+
+#tenant_id -> counter to rotate over the shard
+rotations = dict()
+
+def shuffle_shard(sqs_client, queue_list, tenant_id=None):
+    shard = tenant_shard(tenant_id or "", tuple(queue_list), POOL_SHARD_SIZE)
+    if len(shard) == 1:
+        return shard[0]
+    rotation = rotations.get(tenant_id)
+    if rotation is None:
+        #setdefault keeps one counter when threads race, next() on it is atomic
+        rotation = rotations.setdefault(tenant_id, itertools.count(random.randrange(len(shard))))
+    return shard[next(rotation) % len(shard)]
+
+strategies = {
+    "least_depth": least_depth,
+    "power_of_two": power_of_two,
+    "weighted_random": weighted_random,
+    "shuffle_shard": shuffle_shard,
+}
+
+def select_queue(sqs_client, queue_list, strategy=None, tenant_id=None):
+    if len(queue_list) == 1:
+        return queue_list[0]
+    if queue_list[0].endswith(".fifo"):
+        #the groups of a tenant stay on one queue to keep their order
+        return tenant_shard(tenant_id or "", tuple(queue_list), 1)[0]
+    name = strategy or POOL_STRATEGY
+    if name not in strategies:
+        raise ValueError("Unknown pool strategy: {}".format(name))
+    return strategies[name](sqs_client, queue_list, tenant_id)
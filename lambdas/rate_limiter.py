@@ -0,0 +1,129 @@
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+import logging
+import os
+import threading
+import time
+
+import clients
+
+"""
+Per tenant token bucket rate limiting of the publisher. TENANT_RATE_LIMITS is a JSON document
+with the limits in messages per second (rate) and the bucket size (burst):
+
+  {"default": {"rate": 100, "burst": 200},
+   "tiers": {"premium": {"rate": 1000, "burst": 2000}},
+   "tenants": {"tenant1": "premium", "tenant2": {"rate": 10, "burst": 20}}}
+
+A tenant uses its own limit or tier from "tenants", else the tier of its custom:tier claim,
+else the default. A batch costs a token per message, a batch larger than burst is allowed
+when the bucket is full and then waits for the whole cost to be refilled. Without
+TENANT_RATE_LIMITS nothing is limited. The buckets live in the
+memory of the container. When RATE_LIMIT_TABLE names a DynamoDB table (partition key
+tenant_id), requests allowed by the local bucket are also taken from a bucket shared by all
+containers in that table. The tokens of a request the shared bucket denies go back to the
+local bucket.
+"""
+
+RATE_LIMIT_TABLE = os.environ.get("RATE_LIMIT_TABLE", "")
+
+#tenant_id -> [tokens, last refill time]
+buckets = dict()
+buckets_lock = threading.Lock()
+
+def load_limits():
+    limits = os.environ.get("TENANT_RATE_LIMITS", "")
+    return json.loads(limits) if limits else None
+
+limits = load_limits()
+
+def get_limit(tenant_id, tier=None):
+    tenant_limit = limits.get("tenants", {}).get(tenant_id, tier)
+    if isinstance(tenant_limit, dict):
+        return tenant_limit
+    return limits.get("tiers", {}).get(tenant_limit) or limits.get("default")
+
+def refill(tokens, last, now, limit):
+    return min(float(limit["burst"]), tokens + (now - last) * limit["rate"])
+
+def allow(tenant_id, tier=None, cost=1):
+    """Take cost tokens from the bucket of the tenant, returns (allowed, seconds until allowed)"""
+    if limits is None:
+        return True, 0
+    limit = get_limit(tenant_id, tier)
+    if limit is None:
+        return True, 0
+
+    now = time.time()
+    with buckets_lock:
+        bucket = buckets.get(tenant_id)
+        if bucket is None:
+            bucket = buckets[tenant_id] = [float(limit["burst"]), now]
+        tokens = refill(bucket[0], bucket[1], now, limit)
+        bucket[1] = now
+        if tokens < required(cost, limit):
+            bucket[0] = tokens
+            return False, (required(cost, limit) - tokens) / limit["rate"]
+        bucket[0] = tokens - cost
+
+    if RATE_LIMIT_TABLE:
+        allowed, retry_after = allow_shared(tenant_id, limit, cost, now)
+        if not allowed:
+            #the request is not sent, its tokens go back to the local bucket
+            with buckets_lock:
+                bucket[0] = min(float(limit["burst"]), bucket[0] + cost)
+        return allowed, retry_after
+    return True, 0
+
+def required(cost, limit):
+    #a request larger than the bucket is allowed when the bucket is full, the bucket then goes
+    #negative for the whole cost so the tenant still gets rate messages per second on average
+    return min(cost, limit["burst"])
+
+def allow_shared(tenant_id, limit, cost, now):
+    dynamodb = clients.get_client("dynamodb")
+    key = {"tenant_id": {"S": tenant_id}}
+    #optimistic update, retried when another container updated the bucket in between
+    for _ in range(3):
+        item = dynamodb.get_item(TableName = RATE_LIMIT_TABLE, Key = key, ConsistentRead = True).get("Item")
+        if item is None:
+            tokens, last = float(limit["burst"]), None
+        else:
+            tokens, last = float(item["tokens"]["N"]), item["updated_at"]["N"]
+            tokens = refill(tokens, float(last), now, limit)
+        if tokens < required(cost, limit):
+            return False, (required(cost, limit) - tokens) / limit["rate"]
+
+        condition = "attribute_not_exists(tenant_id)" if last is None else "updated_at = :last"
+        values = {":last": {"N": last}} if last is not None else None
+        try:
+            request = {
+                "TableName": RATE_LIMIT_TABLE,
+                "Item": dict(key, tokens = {"N": repr(tokens - cost)}, updated_at = {"N": repr(now)}),
+                "ConditionExpression": condition,
+            }
+            if values:
+                request["ExpressionAttributeValues"] = values
+            dynamodb.put_item(**request)
+            return True, 0
+        except dynamodb.exceptions.ConditionalCheckFailedException:
+            now = time.time()
+
+    #the shared bucket is contended, rely on the local bucket for this request
+    logging.warning("Shared rate limit bucket of tenant {} is contended".format(tenant_id))
+    return True, 0
@@ -0,0 +1,97 @@
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+
+"""
+Parse an API Gateway proxy event of the publish API in one pass into a Request.
+Header names are matched case-insensitively, as HTTP/2 clients and some proxies send them
+in lower case, the body is validated against the schema of the resource and the bearer token
+is taken from the Authorization header. Only the fields used by the handler are kept, the
+event itself is not copied or serialized.
+  POST /message        {"message": "<body>"}
+  POST /message/batch  {"messages": ["<body>", ...]}
+"""
+
+BATCH_RESOURCE = "/message/batch"
+
+class RequestError(ValueError):
+    """A request that can not be processed, status_code is the HTTP status to answer with"""
+
+    def __init__(self, message, status_code=400):
+        super(RequestError, self).__init__(message)
+        self.status_code = status_code
+
+class Request(object):
+    __slots__ = ("resource", "batch", "headers", "token", "message", "messages")
+
+    def __init__(self, resource, headers, token, messages, batch):
+        self.resource = resource
+        self.batch = batch
+        self.headers = headers
+        self.token = token
+        self.messages = messages
+        #the body of a single message request
+        self.message = None if batch else messages[0]
+
+    def header(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+def normalize_headers(headers):
+    #header name in lower case -> value
+    return {name.lower(): value for name, value in headers.items()}
+
+def bearer_token(headers):
+    """The token of the Authorization header, headers with names in lower case"""
+    authorization = headers.get("authorization")
+    if not authorization:
+        raise RequestError("Missing Authorization in Header", 401)
+    parts = authorization.split()
+    if len(parts) != 2 or parts[0].lower() != "bearer":
+        raise RequestError("Authorization is not a bearer token", 401)
+    return parts[1]
+
+def parse_body(body, batch, max_batch_messages):
+    #returns the list of message bodies of the request
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        raise RequestError("Body is not valid JSON")
+    if not isinstance(data, dict):
+        raise RequestError("Body must be a JSON object")
+
+    if not batch:
+        message = data.get("message")
+        if not isinstance(message, str):
+            raise RequestError("Couldn't create the message.")
+        return [message]
+
+    messages = data.get("messages")
+    if not isinstance(messages, list) or not messages or not all(isinstance(m, str) for m in messages):
+        raise RequestError("Couldn't create the messages.")
+    if len(messages) > max_batch_messages:
+        raise RequestError("Batch exceeds {} messages".format(max_batch_messages))
+    return messages
+
+def parse_request(event, max_batch_messages):
+    headers = event.get("headers")
+    if not headers:
+        raise RequestError("Missing headers", 500)
+    headers = normalize_headers(headers)
+    resource = event.get("resource")
+    batch = resource == BATCH_RESOURCE
+    messages = parse_body(event.get("body"), batch, max_batch_messages)
+    return Request(resource, headers, bearer_token(headers), messages, batch)
@@ -0,0 +1,162 @@
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import base64
+import logging
+import os
+import random
+import threading
+import time
+
+import clients
+import fair_scheduler
+import message_helper
+from botocore.exceptions import ClientError
+
+"""
+Retry scheduling of the records whose handler failed. The visibility of a failed record
+is changed with ChangeMessageVisibilityBatch so it is received again after an exponential
+backoff with jitter: a random delay between RETRY_BASE_SECONDS and
+RETRY_BASE_SECONDS * 2 ^ (ApproximateReceiveCount - 1), capped to RETRY_MAX_SECONDS.
+A record received RETRY_MAX_ATTEMPTS times is moved to the dead-letter queue of its tenant,
+the queue url in the SSM parameter DLQ_PARAMETER_PATH/<tenant_id> or DLQ_DEFAULT_URL, and is
+acknowledged. The dead-letter message keeps the body and attributes sent by the publisher.
+Deferrals of fair_scheduler count as receives too, RETRY_MAX_ATTEMPTS should allow for them.
+"""
+
+RETRY_BASE_SECONDS = int(os.environ.get("RETRY_BASE_SECONDS", "2"))
+#the visibility timeout of SQS is at most 12 hours
+RETRY_MAX_SECONDS = min(int(os.environ.get("RETRY_MAX_SECONDS", "900")), 43200)
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", "8"))
+DLQ_PARAMETER_PATH = os.environ.get("DLQ_PARAMETER_PATH", "/order/dlq")
+DLQ_DEFAULT_URL = os.environ.get("DLQ_DEFAULT_URL")
+
+#tenant_id -> (dead-letter queue url or None, time of lookup)
+dead_letter_queues = dict()
+dead_letter_queues_lock = threading.Lock()
+
+def receive_count(record):
+    return int(record.get("attributes", {}).get("ApproximateReceiveCount", "1"))
+
+def retry_delay(attempts):
+    """Visibility timeout in seconds before the next attempt, after attempts receives"""
+    bound = min(RETRY_BASE_SECONDS * 2 ** min(max(attempts - 1, 0), 32), RETRY_MAX_SECONDS)
+    return int(random.uniform(min(RETRY_BASE_SECONDS, bound), bound))
+
+def dead_letter_queue(tenant_id):
+    if tenant_id == fair_scheduler.UNKNOWN_TENANT:
+        return DLQ_DEFAULT_URL
+    with dead_letter_queues_lock:
+        cached = dead_letter_queues.get(tenant_id)
+    if cached is not None and time.time() - cached[1] <= message_helper.ROUTING_TTL:
+        return cached[0]
+    try:
+        response = clients.get_client("ssm").get_parameter(Name = "{}/{}".format(DLQ_PARAMETER_PATH, tenant_id))
+        queue_url = response["Parameter"]["Value"]
+    except ClientError as err:
+        if err.response["Error"]["Code"] != "ParameterNotFound":
+            raise
+        queue_url = DLQ_DEFAULT_URL
+    with dead_letter_queues_lock:
+        dead_letter_queues[tenant_id] = (queue_url, time.time())
+    return queue_url
+
+def sent_attributes(record):
+    #the message attributes of the record in the format of SendMessage
+    attributes = dict()
+    for name, value in record.get("messageAttributes", {}).items():
+        attribute = {"DataType": value["dataType"]}
+        if value.get("stringValue") is not None:
+            attribute["StringValue"] = value["stringValue"]
+        elif value.get("binaryValue") is not None:
+            binary = value["binaryValue"]
+            #the Lambda event has the binary values base64 encoded
+            attribute["BinaryValue"] = base64.b64decode(binary) if isinstance(binary, str) else binary
+        attributes[name] = attribute
+    return attributes
+
+def dead_letter_entry(record, dlq_url):
+    attributes = sent_attributes(record)
+    attributes["dead_letter_source"] = {"DataType": "String", "StringValue": record["eventSourceARN"].split(":")[-1]}
+    attributes["dead_letter_receive_count"] = {"DataType": "Number", "StringValue": str(receive_count(record))}
+    entry = {
+        "MessageBody": record.get("sentBody", record["body"]),
+        "MessageAttributes": attributes,
+    }
+    if dlq_url.endswith(".fifo"):
+        entry["MessageGroupId"] = record.get("attributes", {}).get("MessageGroupId", fair_scheduler.record_tenant(record))
+        entry["MessageDeduplicationId"] = record["messageId"]
+    return entry
+
+def dead_letter(records_by_queue):
+    """Send the records to their dead-letter queue, returns the message ids sent"""
+    sqs_client = clients.get_client("sqs")
+    sent = []
+    for dlq_url, records in records_by_queue.items():
+        entries = [dead_letter_entry(record, dlq_url) for record in records]
+        for chunk in message_helper.batch_chunks([entry["MessageBody"] for entry in entries],
+                                                 [entry["MessageAttributes"] for entry in entries]):
+            try:
+                response = sqs_client.send_message_batch(
+                    QueueUrl = dlq_url,
+                    Entries = [dict(entries[index], Id = str(index)) for index in chunk])
+            except ClientError as err:
+                logging.error("Could not send %d records to %s: %s", len(chunk), dlq_url, err)
+                continue
+            for entry in response.get("Failed", []):
+                logging.error("Could not send message %s to %s: %s",
+                    records[int(entry["Id"])]["messageId"], dlq_url, entry.get("Code"))
+            sent.extend(records[int(entry["Id"])]["messageId"] for entry in response.get("Successful", []))
+    return sent
+
+def retry(records):
+    """Schedule the retry of the failed records, returns the records that are still failures,
+    the others were moved to their dead-letter queue and can be deleted"""
+    backoffs = []
+    #dead-letter queue url -> records
+    exhausted = dict()
+    for record in records:
+        attempts = receive_count(record)
+        tenant_id = fair_scheduler.record_tenant(record)
+        dlq_url = None
+        if attempts >= RETRY_MAX_ATTEMPTS:
+            try:
+                dlq_url = dead_letter_queue(tenant_id)
+            except ClientError as err:
+                logging.error("Could not look up the dead-letter queue of tenant %s: %s", tenant_id, err)
+            if dlq_url is None:
+                logging.warning("No dead-letter queue for tenant %s, message %s is retried", tenant_id, record["messageId"])
+        if dlq_url is None:
+            backoffs.append((record, retry_delay(attempts)))
+        else:
+            exhausted.setdefault(dlq_url, []).append(record)
+
+    if backoffs:
+        try:
+            fair_scheduler.change_visibility(backoffs)
+        except ClientError as err:
+            #the records come back after the visibility timeout of the queue instead
+            logging.error("Could not schedule the retry of %d records: %s", len(backoffs), err)
+        for record, _ in backoffs:
+            message_helper.put_count("retryScheduled", {"operation": "receive_message", "tenantId": fair_scheduler.record_tenant(record)})
+
+    dead_lettered = set(dead_letter(exhausted)) if exhausted else set()
+    for queue_records in exhausted.values():
+        for record in queue_records:
+            if record["messageId"] in dead_lettered:
+                logging.warning("Message %s moved to the dead-letter queue after %d attempts",
+                    record["messageId"], receive_count(record))
+                message_helper.put_count("deadLettered", {"operation": "receive_message", "tenantId": fair_scheduler.record_tenant(record)})
+    return [record for record in records if record["messageId"] not in dead_lettered]
@@ -15,14 +15,17 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
  
 
+import hashlib
 import json
+import os
+import threading
 import time
-import urllib.request
+from collections import OrderedDict
 
-from jose import jwk, jwt
-from jose.utils import base64url_decode
 import logging
+import log_helper
 import message_helper
+import request_parser
 
 
 #This is for SSL certiticate error in Python when running locally
@@ -45,74 +48,169 @@ with urllib.request.urlopen(keys_url) as f:
 response = f.read()
 keys = json.loads(response.decode('utf-8'))['keys'] 
 """
+
+# The public keys are kept per issuer and indexed by kid. Keys older than JWKS_TTL
+# are refreshed in the background, a kid that is not found (key rotation) forces a
+# refetch, and refetches for an issuer happen at most every JWKS_MIN_REFRESH_INTERVAL
+JWKS_TTL = int(os.environ.get("JWKS_TTL", "3600"))
+JWKS_MIN_REFRESH_INTERVAL = int(os.environ.get("JWKS_MIN_REFRESH_INTERVAL", "30"))
+JWKS_TIMEOUT = int(os.environ.get("JWKS_TIMEOUT", "5"))
+# JWKS_ISSUERS (space separated) are the trusted issuers, their keys are loaded on cold start.
+# When it is set the tokens of other issuers are rejected before any key is fetched, which
+# also bounds keys_map to these issuers
+JWKS_ISSUERS = os.environ.get("JWKS_ISSUERS", "").split()
+
+#issuer -> {"keys": {kid: public_key}, "fetched_at": seconds, "attempted_at": seconds}
 keys_map = dict()
+keys_lock = threading.Lock()
 
-def process_token(header):
-    logging.debug(header)
+def fetch_keys(issuer):
+    import urllib.request
+    keys_url = issuer + '/.well-known/jwks.json'
+    with urllib.request.urlopen(keys_url, timeout=JWKS_TIMEOUT) as f:
+        response = f.read()
+    keys = json.loads(response.decode('utf-8'))['keys']
+    # construct the public keys once, so verifying a token is only a lookup by kid
+    from jose import jwk
+    return {key['kid']: jwk.construct(key) for key in keys}
+
+def refresh_keys(issuer):
+    with keys_lock:
+        entry = keys_map.get(issuer)
+        now = time.time()
+        if entry is not None:
+            if now - entry["attempted_at"] < JWKS_MIN_REFRESH_INTERVAL:
+                return entry
+            entry["attempted_at"] = now
 
-    if str(header).__contains__('Authorization'):
-        authorization = header['Authorization']
-    elif str(header).__contains__('authorization'):
-        authorization = header['authorization']
+    try:
+        keys = fetch_keys(issuer)
+    except Exception as err:
+        if entry is None:
+            raise
+        #keep serving the keys we have, the next refresh is rate limited
+        logging.warning("Refresh of keys for issuer {} failed: {}".format(issuer, err))
+        return entry
+
+    now = time.time()
+    entry = {"keys": keys, "fetched_at": now, "attempted_at": now}
+    with keys_lock:
+        keys_map[issuer] = entry
+    logging.info("Loaded {} keys for issuer: {}".format(len(keys), issuer))
+    return entry
+
+def get_public_key(issuer, kid):
+    entry = keys_map.get(issuer)
+    if entry is None:
+        entry = refresh_keys(issuer)
     else:
-        raise ValueError("Missing Authorization in Header")
-        # return {
-        #     "statusCode": 500,
-        #     "body": json.dumps({
-        #         "message": "Missing Authorization in Header",
-        #     }),
-        #  }    
+        now = time.time()
+        if (now - entry["fetched_at"] > JWKS_TTL
+                and now - entry["attempted_at"] >= JWKS_MIN_REFRESH_INTERVAL):
+            #the current keys stay in use until the refresh completes
+            threading.Thread(target=refresh_keys, args=(issuer,), daemon=True).start()
+
+    public_key = entry["keys"].get(kid)
+    if public_key is None:
+        #the token may be signed with a rotated key we have not seen yet
+        public_key = refresh_keys(issuer)["keys"].get(kid)
+    if public_key is None:
+        raise ValueError('Public key not found in jwks.json')
+    return public_key
+
+def is_trusted_issuer(issuer):
+    return not JWKS_ISSUERS or issuer in JWKS_ISSUERS
 
-    #print('Authorization: {}'.format(authorization))
-    if authorization:
-      bearer = authorization.split()
-      token = bearer[1]
-      #print ('Token {}'.format(token))
-    else: 
-        raise ValueError("Missing Authorization in Header")  
+def warm_keys(issuers=None):
+    #load the keys on cold start for the issuers in JWKS_ISSUERS
+    if issuers is None:
+        issuers = JWKS_ISSUERS
+    for issuer in issuers:
+        try:
+            refresh_keys(issuer)
+        except Exception as err:
+            logging.warning("Could not load keys for issuer {}: {}".format(issuer, err))
 
+# Verified tokens are cached by a hash of the token so a client reusing its ID token
+# does not pay for signature verification again. Entries expire at the token's exp
+# and the least recently used entry is dropped past TOKEN_CACHE_SIZE
+# Lookups are counted as the tokenCacheHit and tokenCacheMiss metrics by operation
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", "1024"))
+
+#sha256 of token -> verified claims
+token_cache = OrderedDict()
+token_cache_lock = threading.Lock()
+token_cache_stats = {"hits": 0, "misses": 0}
+
+def get_cached_claims(token_hash):
+    with token_cache_lock:
+        claims = token_cache.get(token_hash)
+        if claims is not None:
+            if time.time() < claims['exp']:
+                token_cache.move_to_end(token_hash)
+                token_cache_stats["hits"] += 1
+                return dict(claims)
+            del token_cache[token_hash]
+        token_cache_stats["misses"] += 1
+    return None
+
+def cache_claims(token_hash, claims):
+    if TOKEN_CACHE_SIZE <= 0:
+        return
+    with token_cache_lock:
+        token_cache[token_hash] = dict(claims)
+        token_cache.move_to_end(token_hash)
+        while len(token_cache) > TOKEN_CACHE_SIZE:
+            token_cache.popitem(last=False)
+
+def process_token(header):
+    token = request_parser.bearer_token(request_parser.normalize_headers(header))
+    return token, verify_token(token)
+
+def verify_token(token, operation="verify_token"):
+    """Returns the claims of the token once its signature and expiration are verified"""
+    #a token we already verified skips decoding and signature verification
+    token_hash = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    claims = get_cached_claims(token_hash)
+    #the hit ratio of the cache, by the operation of the request
+    message_helper.put_count("tokenCacheHit" if claims is not None else "tokenCacheMiss", {"operation": operation})
+    if claims is not None:
+        log_helper.debug('Token found in cache, hits: %(hits)d, misses: %(misses)d', token_cache_stats)
+        return claims
+
+    #jose is only needed when a token is verified, not for tokens found in the cache
+    from jose.exceptions import JOSEError
+    try:
+        claims = verify_signature(token)
+    except (ValueError, KeyError, JOSEError) as err:
+        #a malformed, untrusted, forged or expired token is answered with 401, not an error of the function
+        raise request_parser.RequestError("Invalid token: {}".format(err), 401)
+
+    cache_claims(token_hash, claims)
+    return claims
+
+def verify_signature(token):
+    """Returns the claims of the token, raises ValueError when its signature or expiration is not valid"""
+    from jose import jwt
+    from jose.utils import base64url_decode
 
     #get the pool id from the issuer in unverified claims to get signature key for token
     claims = jwt.get_unverified_claims(token)
-    logging.debug('Claims {}'.format(claims))
+    log_helper.debug('Token of tenant %s, issued by %s', claims.get('custom:tenant_id'), claims.get('iss'))
     issuer = str(claims['iss'])
+    #the issuer is not verified yet, an unknown one must not make us fetch or cache its keys
+    if not is_trusted_issuer(issuer):
+        raise ValueError('Token issuer is not trusted')
     lastIndex = issuer.rfind('/') + 1
     userPoolId = issuer[lastIndex:]
-    logging.debug('UserPoolId: {}'.format(userPoolId))
-
-    keys_url = issuer + '/.well-known/jwks.json'
-    if keys_url in keys_map:
-        keys = keys_map[keys_url]
-        logging.info("Key found for keys_url: " + keys_url)
-    else:
-        #we store the key in map using the keys_url to reduce calls
-        with urllib.request.urlopen(keys_url) as f:
-            response = f.read()
-        keys = json.loads(response.decode('utf-8'))['keys']
-        keys_map[keys_url] = keys
-        logging.info("Add key for keys_url: " + keys_url)
-
+    log_helper.debug('UserPoolId: %s', userPoolId)
 
     # get the kid from the headers prior to verification
     headers = jwt.get_unverified_headers(token)
     #print('headers {}'.format(headers))
     kid = headers['kid']
-    # search for the kid in the downloaded public keys
-    key_index = -1
-    for i in range(len(keys)):
-        if kid == keys[i]['kid']:
-            key_index = i
-            break
-    if key_index == -1:
-        raise ValueError('Public key not found in jwks.json')
-        # return {
-        #     "statusCode": 500,
-        #     "body": json.dumps({
-        #         "message": "Public key not found in jwks.json",
-        #     }),
-        #  }
-    # construct the public key
-    public_key = jwk.construct(keys[key_index])
+    # look up the already constructed public key for the kid
+    public_key = get_public_key(issuer, kid)
     # get the last two sections of the token,
     # message and signature (encoded in base64)
     message, encoded_signature = str(token).rsplit('.', 1)
@@ -128,7 +226,7 @@ def process_token(header):
         #     }),
         #  }
 
-    logging.debug('Signature of token successfully verified')
+    log_helper.debug('Signature of token successfully verified')
     # since we passed the verification, we can now safely use the claims
 
     # additionally we can verify the token expiration
@@ -148,9 +246,7 @@ def process_token(header):
         #         "message": "Token is expired",
         #     }),
         #  }
-
-
-    return token, claims
+    return claims
  
 
 # the following is useful to make this script executable in both
@@ -0,0 +1,194 @@
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# Behavior checks of the handlers against the local stand-ins of local_aws, for the cases
+# the benchmark does not exercise. Each check raises AssertionError when the behavior is
+# not the expected one, the script exits with an error when a check failed.
+#
+#   python3 behavior_checks.py
+import contextlib
+import io
+import json
+import logging
+import sys
+import traceback
+
+import local_aws
+
+def consume(aws, queue_url):
+    import consumer
+    event = aws.sqs.lambda_event(queue_url)
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = consumer.lambda_handler(event, local_aws.LambdaContext("consume"))
+    return event["Records"], {failure["itemIdentifier"] for failure in response["batchItemFailures"]}
+
+def check_missing_tenant(aws):
+    #a record without tenant_id fails alone, the other records of the batch are processed
+    queue_url = local_aws.queue_url("order_queue_pool1")
+    aws.sqs.send_message(queue_url, "order", MessageAttributes={"tenant_id": {"DataType": "String", "StringValue": "tenant2"}})
+    aws.sqs.send_message(queue_url, "no tenant")
+    records, failures = consume(aws, queue_url)
+    missing = [record["messageId"] for record in records if record["body"] == "no tenant"]
+    assert failures == set(missing), "expected only {} to fail, got {}".format(missing, failures)
+
+def check_batch_rate_limit(aws):
+    #a batch larger than the burst is charged in full, so the tenant keeps to its rate
+    import rate_limiter
+    limits = rate_limiter.limits
+    rate_limiter.limits = {"default": {"rate": 10, "burst": 20}}
+    rate_limiter.buckets.clear()
+    try:
+        allowed, _ = rate_limiter.allow("tenant1", cost=100)
+        assert allowed, "a batch larger than the burst is allowed when the bucket is full"
+        allowed, retry_after = rate_limiter.allow("tenant1", cost=100)
+        assert not allowed and retry_after > 9.9, "expected a wait of 10s, got {} {}".format(allowed, retry_after)
+    finally:
+        rate_limiter.limits = limits
+        rate_limiter.buckets.clear()
+
+def check_batch_size_attributes(aws):
+    #the message attributes count towards the 256KB of a SendMessageBatch call
+    import message_helper
+    body = "x" * 131000
+    attributes = message_helper.message_attributes("t" * 2000)
+    chunks = list(message_helper.batch_chunks([body, body], [attributes, attributes]))
+    assert chunks == [[0], [1]], "expected one body per call, got {}".format(chunks)
+
+def check_claim_check_bucket(aws):
+    #a pointer to another bucket than CLAIM_CHECK_BUCKET is never read, its record fails alone
+    import claim_check
+    import consumer
+    bucket = claim_check.CLAIM_CHECK_BUCKET
+    claim_check.CLAIM_CHECK_BUCKET = "claim-checks"
+    read = []
+    consumer.tenant_handlers["tenant1"] = lambda record, tenant_id: read.append(consumer.read_body(record))
+    try:
+        queue_url = local_aws.queue_url("order_queue_tenant1")
+        attributes = {
+            "tenant_id": {"DataType": "String", "StringValue": "tenant1"},
+            "claim_check": {"DataType": "String", "StringValue": "s3"},
+        }
+        for pointer_bucket in ("claim-checks", "other-bucket"):
+            aws.s3.put_object(Bucket = pointer_bucket, Key = "tenant1/order", Body = b"order")
+            aws.sqs.send_message(queue_url, json.dumps({"bucket": pointer_bucket, "key": "tenant1/order", "size": 5}),
+                MessageAttributes = attributes)
+        records, failures = consume(aws, queue_url)
+        other = [record["messageId"] for record in records if "other-bucket" in record["body"]]
+        assert failures == set(other), "expected only {} to fail, got {}".format(other, failures)
+        assert read == ["order"], "expected one body read, got {}".format(read)
+    finally:
+        claim_check.CLAIM_CHECK_BUCKET = bucket
+        consumer.tenant_handlers.pop("tenant1", None)
+
+def check_untrusted_issuer(aws):
+    #with JWKS_ISSUERS set, a token of another issuer is rejected before its keys are fetched
+    import token_handler
+    jwks = local_aws.JwksServer()
+    issuers = token_handler.JWKS_ISSUERS
+    token_handler.JWKS_ISSUERS = ["https://cognito-idp.us-east-1.amazonaws.com/us-east-1_trusted"]
+    try:
+        try:
+            token_handler.verify_token(jwks.mint_token("tenant1"))
+            raise AssertionError("a token of an untrusted issuer was accepted")
+        except ValueError:
+            pass
+        assert jwks.requests == 0, "the keys of an untrusted issuer were fetched"
+        assert jwks.issuer not in token_handler.keys_map, "the keys of an untrusted issuer were cached"
+    finally:
+        token_handler.JWKS_ISSUERS = issuers
+        jwks.close()
+
+def check_broken_pool_entry(aws):
+    #an entry pointing to a missing pool only breaks the routing of its own tenant
+    import message_helper
+    import poller
+    aws.ssm.parameters["/order/queue/broken"] = "/order/queue/oldpool"
+    message_helper.routing_tables.clear()
+    load_routing_table = message_helper.load_routing_table
+
+    def failing_load(service_name):
+        raise ValueError("No SSM Parameter found for path: /order/queue/oldpool")
+
+    try:
+        tenant1_queues = [local_aws.queue_url("order_queue_tenant1")]
+        assert message_helper.get_queue_list("tenant1", "order") == tenant1_queues
+        assert tenant1_queues[0] in poller.discover_queues("order")
+        try:
+            message_helper.get_queue_list("broken", "order")
+            raise AssertionError("the tenant of a missing pool was routed")
+        except ValueError:
+            pass
+        #a reload that fails keeps the previous table
+        message_helper.load_routing_table = failing_load
+        message_helper.routing_tables["order"]["loaded_at"] = 0
+        assert message_helper.get_queue_list("tenant1", "order") == tenant1_queues
+    finally:
+        message_helper.load_routing_table = load_routing_table
+        message_helper.routing_tables.clear()
+
+def check_rejected_tokens(aws):
+    #expired, malformed and untrusted tokens are answered with 401
+    import app
+    import token_handler
+    jwks = local_aws.JwksServer()
+    issuers = token_handler.JWKS_ISSUERS
+    token_handler.JWKS_ISSUERS = [jwks.issuer]
+    try:
+        other = local_aws.JwksServer()
+        tokens = {
+            "expired": jwks.mint_token("tenant1", expires_in=-60),
+            "malformed": "not-a-token",
+            "untrusted": other.mint_token("tenant1"),
+        }
+        other.close()
+        for name, token in tokens.items():
+            with contextlib.redirect_stdout(io.StringIO()):
+                response = app.lambda_handler(local_aws.publish_event(token, message="order"), local_aws.LambdaContext("publish"))
+            assert response["statusCode"] == 401, "{} token answered {}".format(name, response)
+    finally:
+        token_handler.JWKS_ISSUERS = issuers
+        jwks.close()
+
+CHECKS = [
+    check_rejected_tokens,
+    check_untrusted_issuer,
+    check_missing_tenant,
+    check_claim_check_bucket,
+    check_batch_rate_limit,
+    check_batch_size_attributes,
+    check_broken_pool_entry,
+]
+
+def main():
+    local_aws.setup_path()
+    import consumer
+    #the failures the checks cause are expected, log_helper set the level at import
+    logging.getLogger().setLevel(logging.CRITICAL)
+    failed = 0
+    for check in CHECKS:
+        #each check gets new stand-ins, without messages or cached state of the others
+        aws = local_aws.LocalAws().install()
+        try:
+            check(aws)
+            print("ok      {}".format(check.__name__))
+        except Exception:
+            failed += 1
+            print("FAILED  {}".format(check.__name__))
+            traceback.print_exc()
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
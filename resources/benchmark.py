@@ -0,0 +1,252 @@
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Offline benchmark of the publish and consume paths. app.lambda_handler and
+# consumer.lambda_handler run against the local stand-ins of local_aws with RS256 tokens
+# minted for a local JWKS endpoint, and the latency of each stage is reported with the
+# throughput of publishing and consuming. The benchmark is run --runs times, each in a new
+# process so no cache is shared, and the best result of the runs is kept for every stage and
+# throughput: a noisy run does not fail the comparison, a regression slows down every run.
+# It fails when a result regresses past the stored baseline (benchmark_baseline.json) by more
+# than the tolerance.
+#
+#   python3 benchmark.py                      # compare with the baseline
+#   python3 benchmark.py --update-baseline    # store the results as the new baseline
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import local_aws
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+STAGES = ["verify_token", "routing", "session", "send", "publish", "consume"]
+
+class StageTimer(object):
+
+    def __init__(self):
+        self.samples = {stage: [] for stage in STAGES}
+
+    def wrap(self, stage, function):
+        samples = self.samples[stage]
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                samples.append((time.perf_counter() - start) * 1000)
+        return timed
+
+class TimedClient(object):
+    #times the send calls made with the SQS client of a tenant session
+    def __init__(self, client, timer):
+        self.client = client
+        self.send_message = timer.wrap("send", client.send_message)
+        self.send_message_batch = timer.wrap("send", client.send_message_batch)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    index = max(int(round(p / 100.0 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+def summarize(samples):
+    if not samples:
+        return None
+    return {
+        "count": len(samples),
+        "p50_ms": round(percentile(samples, 50), 4),
+        "p95_ms": round(percentile(samples, 95), 4),
+        "p99_ms": round(percentile(samples, 99), 4),
+    }
+
+def run(args):
+    local_aws.setup_path()
+    #the handlers log as they do in Lambda, but the records are not written anywhere
+    logging.getLogger().addHandler(logging.NullHandler())
+    tenants = ["tenant{}".format(i + 1) for i in range(args.tenants)]
+    silo_tenants = tenants[:max(args.tenants // 4, 1)]
+    pool_tenants = tenants[len(silo_tenants):]
+    aws = local_aws.LocalAws(silo_tenants=silo_tenants, pool_tenants=pool_tenants, pool_size=args.pool_size).install()
+    jwks = local_aws.JwksServer()
+    os.environ["JWKS_ISSUERS"] = jwks.issuer
+
+    timer = StageTimer()
+    import clients
+    create_client = clients.create_client
+    clients.create_client = lambda service_name, region_name=None, **credentials: (
+        TimedClient(create_client(service_name, region_name), timer) if credentials
+        else create_client(service_name, region_name))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app
+        import cognito
+        import consumer
+        import message_helper
+        import token_handler
+
+    token_handler.verify_token = timer.wrap("verify_token", token_handler.verify_token)
+    message_helper.get_queue_url = timer.wrap("routing", message_helper.get_queue_url)
+    cognito.get_sqs_client = timer.wrap("session", cognito.get_sqs_client)
+
+    #each tenant has a few users that reuse their token, like clients of the API do
+    tokens = [jwks.mint_token(tenant_id, sub="{}-user{}".format(tenant_id, u))
+              for tenant_id in tenants for u in range(args.users)]
+    context = local_aws.LambdaContext("publish")
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(args.messages):
+            token = tokens[i % len(tokens)]
+            if args.batch_size > 1:
+                event = local_aws.publish_event(token, messages=["order {}-{}".format(i, j) for j in range(args.batch_size)])
+            else:
+                event = local_aws.publish_event(token, message="order {}".format(i))
+            invocation_start = time.perf_counter()
+            response = app.lambda_handler(event, context)
+            timer.samples["publish"].append((time.perf_counter() - invocation_start) * 1000)
+            if response["statusCode"] != 200:
+                raise Exception("Publish failed: {}".format(response))
+    publish_seconds = time.perf_counter() - start
+    published = args.messages * max(args.batch_size, 1)
+
+    start = time.perf_counter()
+    consumed = 0
+    context = local_aws.LambdaContext("consume")
+    with contextlib.redirect_stdout(io.StringIO()):
+        for queue_url in list(aws.sqs.queues):
+            while aws.sqs.queues[queue_url]:
+                event = aws.sqs.lambda_event(queue_url)
+                invocation_start = time.perf_counter()
+                response = consumer.lambda_handler(event, context)
+                timer.samples["consume"].append((time.perf_counter() - invocation_start) * 1000)
+                consumed += len(event["Records"]) - len(response.get("batchItemFailures", []))
+    consume_seconds = time.perf_counter() - start
+    jwks.close()
+
+    if consumed != published:
+        raise Exception("Published {} messages but consumed {}".format(published, consumed))
+
+    results = {stage: summarize(samples) for stage, samples in timer.samples.items() if samples}
+    results["throughput"] = {
+        "publish_per_s": round(published / publish_seconds, 1),
+        "consume_per_s": round(consumed / consume_seconds, 1),
+    }
+    results["calls"] = {
+        "ssm": aws.ssm.calls,
+        "sqs": aws.sqs.calls,
+        "cognito_identity": aws.cognito_identity.calls,
+        "jwks": jwks.requests,
+    }
+    return results
+
+RUN_SETTINGS = ("messages", "batch_size", "tenants", "users", "pool_size")
+
+def run_isolated(args):
+    command = [sys.executable, os.path.abspath(__file__), "--single-run"]
+    for name in RUN_SETTINGS:
+        command += ["--" + name.replace("_", "-"), str(getattr(args, name))]
+    output = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(output.decode("utf-8"))
+
+def best(runs):
+    #the lowest latencies and the highest throughput of the runs, and the most AWS calls
+    results = dict()
+    for stage in runs[0]:
+        if stage in ("throughput", "calls"):
+            continue
+        results[stage] = dict(runs[0][stage])
+        for name in ("p50_ms", "p95_ms", "p99_ms"):
+            results[stage][name] = min(run[stage][name] for run in runs)
+    results["throughput"] = {name: max(run["throughput"][name] for run in runs) for name in runs[0]["throughput"]}
+    results["calls"] = {name: max(run["calls"][name] for run in runs) for name in runs[0]["calls"]}
+    return results
+
+def regressions(results, baseline, tolerance, slack_ms):
+    found = []
+    for stage, summary in baseline.items():
+        if stage in ("throughput", "calls", "settings") or stage not in results:
+            continue
+        #p99 is reported but not compared, it mostly holds the token cache misses
+        for name in ("p50_ms", "p95_ms"):
+            limit = summary[name] * (1 + tolerance) + slack_ms
+            if results[stage][name] > limit:
+                found.append("{} {} {:.4f} > {:.4f}".format(stage, name, results[stage][name], limit))
+    for name, value in baseline.get("throughput", {}).items():
+        limit = value / (1 + tolerance)
+        if results["throughput"][name] < limit:
+            found.append("throughput {} {:.1f} < {:.1f}".format(name, results["throughput"][name], limit))
+    for name, value in baseline.get("calls", {}).items():
+        #AWS calls are deterministic for a workload, any increase is a regression
+        if results["calls"][name] > value:
+            found.append("calls {} {} > {}".format(name, results["calls"][name], value))
+    return found
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000, help="publish requests to send")
+    parser.add_argument("--batch-size", type=int, default=1, help="messages per request, more than 1 uses /message/batch")
+    parser.add_argument("--tenants", type=int, default=8)
+    parser.add_argument("--users", type=int, default=2, help="users (tokens) per tenant")
+    parser.add_argument("--pool-size", type=int, default=2)
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed relative regression")
+    parser.add_argument("--slack-ms", type=float, default=0.05, help="allowed absolute regression of a latency")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--runs", type=int, default=3, help="runs to keep the best results of")
+    parser.add_argument("--single-run", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single_run:
+        print(json.dumps(run(args)))
+        return
+
+    results = best([run_isolated(args) for _ in range(max(args.runs, 1))])
+    settings = {name: getattr(args, name) for name in RUN_SETTINGS + ("runs",)}
+    print(json.dumps(dict(results, settings=settings), indent=2))
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(dict(results, settings=settings), f, indent=2)
+            f.write("\n")
+        print("Baseline written to {}".format(args.baseline))
+        return
+
+    if not os.path.exists(args.baseline):
+        print("No baseline at {}, run with --update-baseline".format(args.baseline))
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("settings") != settings:
+        print("Baseline was recorded with {}, not comparing".format(baseline.get("settings")))
+        return
+    found = regressions(results, baseline, args.tolerance, args.slack_ms)
+    if found:
+        print("Regressions against {}:".format(args.baseline))
+        for regression in found:
+            print("  " + regression)
+        sys.exit(1)
+    print("No regression against {}".format(args.baseline))
+
+if __name__ == '__main__':
+    main()
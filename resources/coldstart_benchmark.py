@@ -0,0 +1,155 @@
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Measures the cold start of the publish (app) and consume (consumer) handlers: the time to
+# import the handler module and the latency of the first and of a warm invocation. Every run
+# is a fresh interpreter using the local stand-ins of local_aws, so no network is needed.
+# The medians of import_ms and first_ms are compared with the stored baseline
+# (coldstart_baseline.json), the run fails when one regresses by more than the tolerance.
+#
+#   python3 coldstart_benchmark.py --runs 10
+#   python3 coldstart_benchmark.py --update-baseline  # store the results as the new baseline
+#   python3 coldstart_benchmark.py --importtime app    # slowest imports of a module
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import local_aws
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "coldstart_baseline.json")
+#the cold start timings compared with the baseline, warm_ms is covered by benchmark.py
+COMPARED = ("import_ms", "first_ms")
+
+def child(module_name):
+    aws = local_aws.LocalAws().install()
+    event_args = json.loads(os.environ["BENCH_EVENT"])
+
+    start = time.perf_counter()
+    module = __import__(module_name)
+    import_ms = (time.perf_counter() - start) * 1000
+
+    if module_name == "app":
+        make_event = lambda: local_aws.publish_event(event_args["token"], message="cold start order")
+    else:
+        for i in range(10):
+            aws.sqs.send_message(QueueUrl=local_aws.queue_url("order_queue_pool1"), MessageBody="order {}".format(i),
+                MessageAttributes={"tenant_id": {"StringValue": "tenant2", "DataType": "String"}})
+        make_event = lambda: aws.sqs.lambda_event(local_aws.queue_url("order_queue_pool1"))
+
+    timings = []
+    for _ in range(2):
+        event = make_event()
+        start = time.perf_counter()
+        response = module.lambda_handler(event, local_aws.LambdaContext())
+        timings.append((time.perf_counter() - start) * 1000)
+
+    if module_name == "app" and response["statusCode"] != 200:
+        raise Exception("Publish failed: {}".format(response))
+    sys.stderr.write(json.dumps({"import_ms": import_ms, "first_ms": timings[0], "warm_ms": timings[1]}) + "\n")
+
+def run(module_name, runs, jwks):
+    token = jwks.mint_token("tenant2")
+    env = dict(os.environ, BENCH_EVENT=json.dumps({"token": token}), JWKS_ISSUERS=jwks.issuer)
+    results = []
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", module_name],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        results.append(json.loads(proc.stderr.strip().splitlines()[-1]))
+    return results
+
+def importtime(module_name, top):
+    local_aws.setup_path()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module_name],
+        cwd=local_aws.LAMBDAS_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]), parts[2].rstrip()))
+    for cumulative, name in sorted(rows, reverse=True)[:top]:
+        print("{:>10.1f} ms {}".format(cumulative / 1000.0, name))
+
+def regressions(report, baseline, tolerance, slack_ms):
+    found = []
+    for module_name, timings in baseline.items():
+        if module_name not in report:
+            continue
+        for name in COMPARED:
+            limit = timings[name]["median"] * (1 + tolerance) + slack_ms
+            if report[module_name][name]["median"] > limit:
+                found.append("{} {} median {:.2f} > {:.2f}".format(module_name, name, report[module_name][name]["median"], limit))
+    return found
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--modules", nargs="+", default=["app", "consumer"])
+    parser.add_argument("--importtime", metavar="MODULE")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--tolerance", type=float, default=0.3, help="allowed relative regression of a median")
+    parser.add_argument("--slack-ms", type=float, default=5.0, help="allowed absolute regression of a median")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return
+    if args.importtime:
+        importtime(args.importtime, args.top)
+        return
+
+    jwks = local_aws.JwksServer()
+    report = dict()
+    for module_name in args.modules:
+        results = run(module_name, args.runs, jwks)
+        report[module_name] = {
+            name: {
+                "median": round(statistics.median(r[name] for r in results), 2),
+                "min": round(min(r[name] for r in results), 2),
+                "max": round(max(r[name] for r in results), 2),
+            } for name in ("import_ms", "first_ms", "warm_ms")
+        }
+    jwks.close()
+    print(json.dumps(report, indent=2))
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print("Baseline written to {}".format(args.baseline))
+        return
+
+    if not os.path.exists(args.baseline):
+        print("No baseline at {}, run with --update-baseline".format(args.baseline))
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    found = regressions(report, baseline, args.tolerance, args.slack_ms)
+    if found:
+        print("Regressions against {}:".format(args.baseline))
+        for regression in found:
+            print("  " + regression)
+        sys.exit(1)
+    print("No regression against {}".format(args.baseline))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,364 @@
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Local stand-ins for the AWS services used by the lambdas (SQS, SSM, S3, Cognito Identity)
+# and for the JWKS endpoint of a Cognito user pool, to run the handlers without network.
+# install() makes clients.create_client return the stand-ins.
+import datetime
+import hashlib
+import http.server
+import io
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+
+LAMBDAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambdas")
+ACCOUNT_ID = "123456789012"
+REGION = "us-east-1"
+
+LAMBDA_ENVIRONMENT = {
+    "AWS_LAMBDA_FUNCTION_NAME": "local",
+    "AWS_LAMBDA_FUNCTION_VERSION": "$LATEST",
+    "AWS_REGION": REGION,
+    "AWS_DEFAULT_REGION": REGION,
+    "ENVIRONMENT": "local",
+    "NAMESPACE": "sqs-multi-tenancy",
+}
+
+def setup_path():
+    #make the lambda modules importable and give them the Lambda environment variables
+    if LAMBDAS_DIR not in sys.path:
+        sys.path.insert(0, LAMBDAS_DIR)
+    for name, value in LAMBDA_ENVIRONMENT.items():
+        os.environ.setdefault(name, value)
+
+def client_error(code, operation_name, message=""):
+    from botocore.exceptions import ClientError
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation_name)
+
+def queue_url(queue_name):
+    return "https://sqs.{}.amazonaws.com/{}/{}".format(REGION, ACCOUNT_ID, queue_name)
+
+def queue_arn(url):
+    return "arn:aws:sqs:{}:{}:{}".format(REGION, ACCOUNT_ID, url.split("/")[-1])
+
+
+class LocalSSM(object):
+
+    def __init__(self, parameters=None):
+        self.parameters = dict(parameters or {})
+        self.calls = 0
+
+    def get_parameter(self, Name, **kwargs):
+        self.calls += 1
+        if Name not in self.parameters:
+            raise client_error("ParameterNotFound", "GetParameter")
+        return {"Parameter": {"Name": Name, "Value": self.parameters[Name]}}
+
+    def put_parameter(self, Name, Value, Overwrite=False, **kwargs):
+        self.calls += 1
+        if Name in self.parameters and not Overwrite:
+            raise client_error("ParameterAlreadyExists", "PutParameter")
+        self.parameters[Name] = Value
+        return {"Version": 1}
+
+    def get_paginator(self, operation_name):
+        return LocalPaginator(self)
+
+    def get_parameters_by_path(self, Path, Recursive=False, **kwargs):
+        self.calls += 1
+        prefix = Path.rstrip("/") + "/"
+        return [{"Name": name, "Value": value} for name, value in sorted(self.parameters.items())
+                if name.startswith(prefix) and (Recursive or "/" not in name[len(prefix):])]
+
+
+class LocalPaginator(object):
+
+    def __init__(self, ssm):
+        self.ssm = ssm
+
+    def paginate(self, Path, Recursive=False, **kwargs):
+        parameters = self.ssm.get_parameters_by_path(Path, Recursive)
+        #GetParametersByPath returns at most 10 parameters per page
+        for start in range(0, max(len(parameters), 1), 10):
+            yield {"Parameters": parameters[start:start + 10]}
+
+
+class LocalSQS(object):
+
+    def __init__(self, queue_names=()):
+        self.queues = dict()
+        #receipt handle -> (queue url, message) of received messages
+        self.inflight = dict()
+        self.calls = 0
+        self.lock = threading.Lock()
+        for queue_name in queue_names:
+            self.create_queue(QueueName=queue_name)
+
+    def create_queue(self, QueueName, **kwargs):
+        url = queue_url(QueueName)
+        self.queues.setdefault(url, deque())
+        return {"QueueUrl": url}
+
+    def get_queue(self, QueueUrl):
+        if QueueUrl not in self.queues:
+            raise client_error("AWS.SimpleQueueService.NonExistentQueue", "SendMessage")
+        return self.queues[QueueUrl]
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames=(), **kwargs):
+        self.calls += 1
+        return {"Attributes": {"ApproximateNumberOfMessages": str(len(self.get_queue(QueueUrl)))}}
+
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes=None, **kwargs):
+        self.calls += 1
+        message = {
+            "MessageId": str(uuid.uuid4()),
+            "ReceiptHandle": str(uuid.uuid4()),
+            "Body": MessageBody,
+            "MD5OfBody": hashlib.md5(MessageBody.encode("utf-8")).hexdigest(),
+            "MessageAttributes": MessageAttributes or {},
+            "Attributes": {
+                "SentTimestamp": str(int(time.time() * 1000)),
+                "ApproximateReceiveCount": "0",
+            },
+        }
+        for name in ("MessageGroupId", "MessageDeduplicationId"):
+            if name in kwargs:
+                message["Attributes"][name] = kwargs[name]
+        with self.lock:
+            self.get_queue(QueueUrl).append(message)
+        return {"MessageId": message["MessageId"], "MD5OfMessageBody": message["MD5OfBody"]}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        successful = []
+        for entry in Entries:
+            entry = dict(entry)
+            entry_id = entry.pop("Id")
+            response = self.send_message(QueueUrl, **entry)
+            successful.append({"Id": entry_id, "MessageId": response["MessageId"]})
+        return {"Successful": successful, "Failed": []}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, **kwargs):
+        self.calls += 1
+        messages = []
+        with self.lock:
+            queue = self.get_queue(QueueUrl)
+            while queue and len(messages) < MaxNumberOfMessages:
+                message = queue.popleft()
+                message["Attributes"]["ApproximateReceiveCount"] = str(int(message["Attributes"]["ApproximateReceiveCount"]) + 1)
+                message["ReceiptHandle"] = str(uuid.uuid4())
+                self.inflight[message["ReceiptHandle"]] = (QueueUrl, message)
+                messages.append(message)
+        return {"Messages": messages} if messages else {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.calls += 1
+        with self.lock:
+            for entry in Entries:
+                self.inflight.pop(entry["ReceiptHandle"], None)
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries], "Failed": []}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        #the visibility timeout is not simulated, the messages are visible again right away
+        self.calls += 1
+        with self.lock:
+            for entry in Entries:
+                queue_url, message = self.inflight.pop(entry["ReceiptHandle"])
+                self.queues[queue_url].append(message)
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries], "Failed": []}
+
+    def lambda_event(self, QueueUrl, batch_size=10):
+        #receive up to batch_size messages as the SQS event of a Lambda event source mapping
+        records = []
+        for message in self.receive_message(QueueUrl, MaxNumberOfMessages=batch_size).get("Messages", []):
+            records.append({
+                "messageId": message["MessageId"],
+                "receiptHandle": message["ReceiptHandle"],
+                "body": message["Body"],
+                "attributes": message["Attributes"],
+                "messageAttributes": {
+                    name: {"stringValue": value.get("StringValue"), "dataType": value["DataType"]}
+                    for name, value in message["MessageAttributes"].items()
+                },
+                "md5OfBody": message["MD5OfBody"],
+                "eventSource": "aws:sqs",
+                "eventSourceARN": queue_arn(QueueUrl),
+                "awsRegion": REGION,
+            })
+        return {"Records": records}
+
+
+class LocalS3(object):
+    """The object store of the claim checks, objects are kept in memory by (bucket, key)"""
+
+    def __init__(self):
+        self.objects = dict()
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.calls += 1
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        with self.lock:
+            self.objects[(Bucket, Key)] = bytes(Body)
+        return {"ETag": '"{}"'.format(hashlib.md5(Body).hexdigest())}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self.calls += 1
+        with self.lock:
+            if (Bucket, Key) not in self.objects:
+                raise client_error("NoSuchKey", "GetObject")
+            data = self.objects[(Bucket, Key)]
+        #like the StreamingBody of boto3, the body is read from a stream
+        return {"Body": io.BytesIO(data), "ContentLength": len(data)}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.calls += 1
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+
+class LocalCognitoIdentity(object):
+
+    def __init__(self, expires_in=3600):
+        self.expires_in = expires_in
+        self.calls = 0
+
+    def get_id(self, AccountId, IdentityPoolId, Logins):
+        self.calls += 1
+        login = list(Logins.values())[0]
+        return {"IdentityId": "{}:{}".format(REGION, hashlib.sha1(login.encode("utf-8")).hexdigest())}
+
+    def get_credentials_for_identity(self, IdentityId, Logins=None):
+        self.calls += 1
+        return {
+            "IdentityId": IdentityId,
+            "Credentials": {
+                "AccessKeyId": "ASIALOCAL",
+                "SecretKey": "local",
+                "SessionToken": "local",
+                "Expiration": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.expires_in),
+            },
+        }
+
+
+class LocalAws(object):
+    """The stand-ins of one local account, with the SSM routing entries of template.yaml"""
+
+    def __init__(self, silo_tenants=("tenant1",), pool_tenants=("tenant2",), pool_size=2, service_name="order"):
+        pool_names = ["{}_queue_pool{}".format(service_name, i + 1) for i in range(pool_size)]
+        silo_names = ["{}_queue_{}".format(service_name, tenant_id) for tenant_id in silo_tenants]
+        self.sqs = LocalSQS(pool_names + silo_names)
+        self.cognito_identity = LocalCognitoIdentity()
+        self.s3 = LocalS3()
+        pool_path = "/{}/queue/pool".format(service_name)
+        parameters = {pool_path: " ".join(queue_url(name) for name in pool_names)}
+        for tenant_id, name in zip(silo_tenants, silo_names):
+            parameters["/{}/queue/{}".format(service_name, tenant_id)] = queue_url(name)
+        for tenant_id in pool_tenants:
+            parameters["/{}/queue/{}".format(service_name, tenant_id)] = pool_path
+        self.ssm = LocalSSM(parameters)
+
+    def create_client(self, service_name, region_name=None, **credentials):
+        return {
+            "sqs": self.sqs,
+            "ssm": self.ssm,
+            "s3": self.s3,
+            "cognito-identity": self.cognito_identity,
+        }[service_name]
+
+    def install(self):
+        setup_path()
+        import clients
+        clients.clients.clear()
+        clients.create_client = self.create_client
+        return self
+
+
+class JwksServer(object):
+    """Serves the JWKS of a local user pool on 127.0.0.1 and mints RS256 ID tokens for it"""
+
+    def __init__(self, kid="local-key"):
+        import rsa
+        from jose.utils import long_to_base64
+        public_key, self.private_key = rsa.newkeys(2048)
+        self.kid = kid
+        self.jwks = json.dumps({"keys": [{
+            "kty": "RSA", "alg": "RS256", "use": "sig", "kid": kid,
+            "n": long_to_base64(public_key.n).decode("utf-8"),
+            "e": long_to_base64(public_key.e).decode("utf-8"),
+        }]}).encode("utf-8")
+        self.requests = 0
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(server.jwks)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.issuer = "http://127.0.0.1:{}/{}_local".format(self.httpd.server_port, REGION)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def mint_token(self, tenant_id, sub=None, identity_pool=None, expires_in=3600):
+        from jose import jwt
+        now = int(time.time())
+        claims = {
+            "sub": sub or str(uuid.uuid4()),
+            "iss": self.issuer,
+            "token_use": "id",
+            "custom:tenant_id": tenant_id,
+            "custom:identity_pool": identity_pool or "{}:{}".format(REGION, uuid.uuid5(uuid.NAMESPACE_URL, tenant_id)),
+            "iat": now,
+            "exp": now + expires_in,
+        }
+        return jwt.encode(claims, self.private_key.save_pkcs1().decode("utf-8"), algorithm="RS256", headers={"kid": self.kid})
+
+    def close(self):
+        self.httpd.shutdown()
+
+
+class LambdaContext(object):
+
+    def __init__(self, function_name="local"):
+        self.function_name = function_name
+        self.aws_request_id = str(uuid.uuid4())
+        self.invoked_function_arn = "arn:aws:lambda:{}:{}:function:{}".format(REGION, ACCOUNT_ID, function_name)
+
+def publish_event(token, message=None, messages=None):
+    #the API Gateway proxy event of POST /message, or of POST /message/batch with messages
+    resource = "/message/batch" if messages is not None else "/message"
+    body = {"messages": messages} if messages is not None else {"message": message}
+    return {
+        "resource": resource,
+        "path": resource,
+        "httpMethod": "POST",
+        "headers": {"Authorization": "Bearer " + token, "Content-Type": "application/json"},
+        "body": json.dumps(body),
+        "isBase64Encoded": False,
+    }
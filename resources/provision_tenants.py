@@ -0,0 +1,209 @@
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Onboard many tenants at once, for load tests or for a real onboarding. Each tenant gets a
+# Cognito user with the helpers of user.py, either its own queue (silo) or the pool queues,
+# the /<service>/queue/<tenant> SSM routing entry and a token. Tenants are provisioned
+# concurrently and calls that are throttled are retried with exponential backoff and jitter.
+# Silo users are created in the user pool of the Tenant1 outputs of the stack and pool users
+# in the one of Tenant2, whose roles allow their tenants to send to these queues.
+# Provisioning is idempotent, a tenant that already exists is completed and gets a new token,
+# but only when its routing entry is the one it would get: an id routed elsewhere, like the
+# tenants of the stack itself, fails before anything is changed.
+#
+#   python3 provision_tenants.py --silo 100 --pool 2000 --prefix load > tenants.jsonl
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+import user
+
+THROTTLING_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+    "RequestThrottled",
+    "SlowDown",
+}
+MAX_ATTEMPTS = 10
+BASE_DELAY = 0.2
+MAX_DELAY = 20.0
+
+TENANT_ID_PATTERN = re.compile(r"^[a-z0-9_-]{1,64}$")
+
+def with_backoff(call, **kwargs):
+    """Call an AWS API, retrying throttled calls with full jitter exponential backoff"""
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            return call(**kwargs)
+        except ClientError as err:
+            if err.response.get("Error", {}).get("Code") not in THROTTLING_CODES or attempt == MAX_ATTEMPTS - 1:
+                raise
+        time.sleep(random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt)))
+
+def stack_outputs(cloudformation, stack_name):
+    stacks = with_backoff(cloudformation.describe_stacks, StackName = stack_name)["Stacks"]
+    return {output["OutputKey"]: output["OutputValue"] for output in stacks[0].get("Outputs", [])}
+
+def tenant_pools(outputs, key_prefix):
+    #user pool, app client and identity pool of the tenant outputs of the stack
+    return {
+        "userPoolId": outputs[key_prefix + "UserPool"],
+        "poolClientId": outputs[key_prefix + "UserPoolClient"],
+        "identityPoolId": outputs[key_prefix + "IdentityPool"],
+    }
+
+class Provisioner(object):
+
+    def __init__(self, idp, sqs, ssm, pools, service_name="order"):
+        self.idp = idp
+        self.sqs = sqs
+        self.ssm = ssm
+        #"silo" or "pool" -> tenant_pools
+        self.pools = pools
+        self.service_name = service_name
+        self.pool_path = "/{}/queue/pool".format(service_name)
+
+    def provision(self, tenant_id, model):
+        if not TENANT_ID_PATTERN.match(tenant_id):
+            raise ValueError("Invalid tenant id: {}".format(tenant_id))
+        pools = self.pools[model]
+        user_name = "user@{}.com".format(tenant_id)
+        parameter_name = "/{}/queue/{}".format(self.service_name, tenant_id)
+        queue_name = "{}_queue_{}".format(self.service_name, tenant_id)
+        existing = self.existing_route(parameter_name)
+        if existing is not None and not self.is_route(existing, model, queue_name):
+            raise ValueError("Tenant {} is already routed to {}".format(tenant_id, existing))
+
+        try:
+            with_backoff(user.create_cognito_user, client = self.idp, userPoolId = pools["userPoolId"],
+                identityPoolId = pools["identityPoolId"], tenantUserName = user_name, tenantId = tenant_id)
+        except ClientError as err:
+            if err.response.get("Error", {}).get("Code") != "UsernameExistsException":
+                raise
+        with_backoff(user.update_user_password, client = self.idp, userPoolId = pools["userPoolId"], tenantUserName = user_name)
+
+        if model == "silo":
+            queue = with_backoff(self.sqs.create_queue, QueueName = queue_name)["QueueUrl"]
+            route = queue
+        else:
+            queue = None
+            route = self.pool_path
+        if existing is None:
+            #never overwritten, a concurrent onboarding of the same id fails here
+            with_backoff(self.ssm.put_parameter, Name = parameter_name, Value = route, Type = "String", Overwrite = False)
+
+        response = with_backoff(self.idp.admin_initiate_auth,
+            UserPoolId = pools["userPoolId"],
+            ClientId = pools["poolClientId"],
+            AuthFlow = "ADMIN_NO_SRP_AUTH",
+            AuthParameters = {"USERNAME": user_name, "PASSWORD": "ABCdef123"})
+
+        return {
+            "tenantId": tenant_id,
+            "model": model,
+            "userName": user_name,
+            "queue": queue or route,
+            "token": response["AuthenticationResult"]["IdToken"],
+        }
+
+    def is_route(self, route, model, queue_name):
+        if model == "pool":
+            return route == self.pool_path
+        #the url of the silo queue of the tenant
+        return route.rsplit("/", 1)[-1] == queue_name
+
+    def existing_route(self, parameter_name):
+        try:
+            return with_backoff(self.ssm.get_parameter, Name = parameter_name)["Parameter"]["Value"]
+        except ClientError as err:
+            if err.response.get("Error", {}).get("Code") != "ParameterNotFound":
+                raise
+            return None
+
+def provision_all(provisioner, tenants, workers, output):
+    """Provision (tenant_id, model) pairs, write a JSON line per tenant, returns the failed tenant ids"""
+    failed = []
+    done = 0
+    output_lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(provisioner.provision, tenant_id, model): tenant_id for tenant_id, model in tenants}
+        for future in as_completed(futures):
+            tenant_id = futures[future]
+            try:
+                result = future.result()
+            except Exception as err:
+                print("Tenant {} failed: {}".format(tenant_id, err), file=sys.stderr)
+                failed.append(tenant_id)
+                continue
+            with output_lock:
+                output.write(json.dumps(result) + "\n")
+            done += 1
+            if done % 100 == 0:
+                print("{} of {} tenants provisioned".format(done, len(futures)), file=sys.stderr)
+    return failed
+
+def tenant_list(prefix, silo, pool):
+    width = len(str(silo + pool))
+    tenants = [("{}{}".format(prefix, str(i + 1).zfill(width)), "silo") for i in range(silo)]
+    tenants += [("{}{}".format(prefix, str(silo + i + 1).zfill(width)), "pool") for i in range(pool)]
+    return tenants
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stack", default="sqs-app")
+    parser.add_argument("--service", default="order")
+    parser.add_argument("--prefix", required=True, help="tenant ids are the prefix and a number, e.g. load")
+    parser.add_argument("--silo", type=int, default=0, help="number of tenants with their own queue")
+    parser.add_argument("--pool", type=int, default=0, help="number of tenants on the pool queues")
+    parser.add_argument("--silo-key-prefix", default="Tenant1", help="stack outputs of the user pool of silo tenants")
+    parser.add_argument("--pool-key-prefix", default="Tenant2", help="stack outputs of the user pool of pool tenants")
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--output", help="file for the JSON lines of the tenants, stdout by default")
+    args = parser.parse_args()
+
+    config = Config(max_pool_connections=args.workers, retries={"max_attempts": 0})
+    outputs = stack_outputs(boto3.client("cloudformation"), args.stack)
+    provisioner = Provisioner(
+        boto3.client("cognito-idp", config=config),
+        boto3.client("sqs", config=config),
+        boto3.client("ssm", config=config),
+        {"silo": tenant_pools(outputs, args.silo_key_prefix), "pool": tenant_pools(outputs, args.pool_key_prefix)},
+        args.service)
+
+    tenants = tenant_list(args.prefix.lower(), args.silo, args.pool)
+    start = time.time()
+    if args.output:
+        with open(args.output, "w") as output:
+            failed = provision_all(provisioner, tenants, args.workers, output)
+    else:
+        failed = provision_all(provisioner, tenants, args.workers, sys.stdout)
+    print("Provisioned {} of {} tenants in {:.1f}s".format(len(tenants) - len(failed), len(tenants), time.time() - start), file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Microbenchmark of the request parsing of the publish handler. It compares the previous
+# checks, which serialized the event and the headers to strings to test for a key and
+# formatted the whole event for the log, with request_parser.parse_request.
+#
+#   python3 request_benchmark.py --number 20000
+import argparse
+import json
+import timeit
+
+import local_aws
+
+def api_event(message_count):
+    #a proxy event like API Gateway sends it, with the headers of a browser behind CloudFront
+    headers = {
+        "Accept": "application/json",
+        "Accept-Encoding": "gzip, deflate, br",
+        "Accept-Language": "en-US,en;q=0.9",
+        "Authorization": "Bearer " + "e" * 900,
+        "CloudFront-Forwarded-Proto": "https",
+        "CloudFront-Is-Desktop-Viewer": "true",
+        "CloudFront-Viewer-Country": "US",
+        "Content-Type": "application/json",
+        "Host": "abc123.execute-api.us-east-1.amazonaws.com",
+        "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko)",
+        "Via": "2.0 0123456789abcdef.cloudfront.net (CloudFront)",
+        "X-Amz-Cf-Id": "x" * 56,
+        "X-Amzn-Trace-Id": "Root=1-5f1b2c3d-0123456789abcdef01234567",
+        "X-Forwarded-For": "203.0.113.10, 198.51.100.20",
+        "X-Forwarded-Port": "443",
+        "X-Forwarded-Proto": "https",
+    }
+    event = local_aws.publish_event(headers["Authorization"].split()[1],
+        messages=["order {}".format(i) for i in range(message_count)] if message_count > 1 else None,
+        message="order 1" if message_count == 1 else None)
+    event["headers"] = headers
+    event["multiValueHeaders"] = {name: [value] for name, value in headers.items()}
+    return event
+
+def legacy_parse(event):
+    #the checks of app.lambda_handler and token_handler.process_token before request_parser
+    #logging.info(event) formatted the event
+    str(event)
+    if not str(event).__contains__('headers'):
+        raise ValueError("Missing headers")
+    data = json.loads(event['body'])
+    if event.get('resource') == "/message/batch":
+        messages = data.get('messages')
+        if not isinstance(messages, list) or not messages or not all(isinstance(m, str) for m in messages):
+            raise ValueError("Couldn't create the messages.")
+    elif 'message' not in data:
+        raise ValueError("Couldn't create the message.")
+    header = event['headers']
+    #logging.debug(header)
+    str(header)
+    if str(header).__contains__('Authorization'):
+        authorization = header['Authorization']
+    elif str(header).__contains__('authorization'):
+        authorization = header['authorization']
+    else:
+        raise ValueError("Missing Authorization in Header")
+    return authorization.split()[1]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20000, help="parses per measurement")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    local_aws.setup_path()
+    import request_parser
+
+    results = dict()
+    for name, message_count in (("single", 1), ("batch_10", 10), ("batch_100", 100)):
+        event = api_event(message_count)
+        assert legacy_parse(event) == request_parser.parse_request(event, 500).token
+        legacy = min(timeit.repeat(lambda: legacy_parse(event), number=args.number, repeat=args.repeat))
+        parsed = min(timeit.repeat(lambda: request_parser.parse_request(event, 500), number=args.number, repeat=args.repeat))
+        results[name] = {
+            "legacy_us": round(legacy / args.number * 1e6, 2),
+            "request_parser_us": round(parsed / args.number * 1e6, 2),
+            "saved_us": round((legacy - parsed) / args.number * 1e6, 2),
+        }
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
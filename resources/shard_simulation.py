@@ -0,0 +1,95 @@
+
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Simulates the shuffle_shard pool strategy of queue_selector to show how far the load of one
+# tenant spreads, compared with pool strategies that use every queue of the pool:
+# - the queues a noisy tenant sends to, and the other tenants that share all or some of them
+# - the number of tenants per queue
+# - the tenants whose shard moves when a queue is added to or removed from the pool, next to
+#   the ideal and to a tenant hash modulo the number of queues
+# No AWS call is made, the queue urls are generated.
+#
+#   python3 shard_simulation.py --tenants 1000 --queues 8 --shard-size 2
+import argparse
+import hashlib
+import json
+
+import local_aws
+
+def pool(size):
+    return [local_aws.queue_url("order_queue_pool{}".format(i + 1)) for i in range(size)]
+
+def modulo_shard(tenant_id, queues, shard_size):
+    #consecutive queues from the hash of the tenant, for comparison
+    start = int(hashlib.md5(tenant_id.encode("utf-8")).hexdigest(), 16) % len(queues)
+    return tuple(queues[(start + i) % len(queues)] for i in range(min(shard_size, len(queues))))
+
+def moved(shard_function, tenants, before, after, shard_size):
+    #fraction of tenants with at least one queue of their shard changed
+    count = sum(1 for tenant_id in tenants
+        if set(shard_function(tenant_id, tuple(before), shard_size)) != set(shard_function(tenant_id, tuple(after), shard_size)))
+    return round(count / len(tenants), 4)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tenants", type=int, default=1000)
+    parser.add_argument("--queues", type=int, default=8)
+    parser.add_argument("--shard-size", type=int, default=2)
+    args = parser.parse_args()
+
+    local_aws.setup_path()
+    import queue_selector
+    shard = queue_selector.tenant_shard.__wrapped__
+
+    queues = pool(args.queues)
+    tenants = ["tenant{}".format(i + 1) for i in range(args.tenants)]
+    shards = {tenant_id: set(shard(tenant_id, tuple(queues), args.shard_size)) for tenant_id in tenants}
+
+    #the first tenant is the noisy one
+    noisy = shards[tenants[0]]
+    others = [shards[tenant_id] for tenant_id in tenants[1:]]
+    tenants_per_queue = [sum(1 for s in shards.values() if queue_url in s) for queue_url in queues]
+
+    ideal_add = args.shard_size / (args.queues + 1)
+    ideal_remove = args.shard_size / args.queues
+    results = {
+        "noisy_tenant": {
+            "queues_used": len(noisy),
+            "pool_queues": len(queues),
+            "tenants_sharing_all_queues": round(sum(1 for s in others if s <= noisy) / len(others), 4),
+            "tenants_sharing_a_queue": round(sum(1 for s in others if s & noisy) / len(others), 4),
+            "tenants_sharing_with_full_pool": 1.0,
+        },
+        "tenants_per_queue": {
+            "min": min(tenants_per_queue),
+            "mean": round(sum(tenants_per_queue) / len(queues), 1),
+            "max": max(tenants_per_queue),
+        },
+        "moved_on_queue_added": {
+            "rendezvous": moved(shard, tenants, queues, pool(args.queues + 1), args.shard_size),
+            "modulo": moved(modulo_shard, tenants, queues, pool(args.queues + 1), args.shard_size),
+            "ideal": round(ideal_add, 4),
+        },
+        "moved_on_queue_removed": {
+            "rendezvous": moved(shard, tenants, queues, queues[:-1], args.shard_size),
+            "modulo": moved(modulo_shard, tenants, queues, queues[:-1], args.shard_size),
+            "ideal": round(ideal_remove, 4),
+        },
+    }
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()